@@ -21,7 +21,7 @@ sys.path.insert(0, '../..')
 
 from utils.persistency.logger import Logger
 
-from utils.dataset.build_dataset import load_MNIST_data
+from utils.dataset.build_dataset import load_MNIST_data, load_MNIST_data_preloaded
 from utils.dataset.build_dataloader import init_data_loader
 
 from utils.training.train_loop import full_train_loop
@@ -49,7 +49,13 @@ OUTPUTS_FOLDER_PATH_DB = 'output_files_MNIST/db'
 #%% md
 ## Load Data
 #%%
-train_dataset, val_dataset, test_dataset = load_MNIST_data('data_MNIST/')
+# Opt-in: the whole dataset decoded once and kept on the training device
+PRELOAD_DATA = False
+
+if PRELOAD_DATA:
+    train_dataset, val_dataset, test_dataset = load_MNIST_data_preloaded('data_MNIST/', device=get_device())
+else:
+    train_dataset, val_dataset, test_dataset = load_MNIST_data('data_MNIST/')
 #%% md
 ## Optuna Optimization
 #%% md
@@ -0,0 +1,51 @@
+#%% md
+# Particle Swarm Optimization - Synthetic Benchmark
+#%% md
+## Environment Setup
+#%% md
+### Import Dependencies
+#%%
+import warnings
+warnings.filterwarnings('ignore')
+
+import sys
+sys.path.insert(0, '..')
+sys.path.insert(0, '../..')
+
+from utils.persistency.file_name_builder import folder_exists_check, file_name_builder
+from experiments.PSO_experiment.backend.pso_benchmark import run_benchmark_grid
+#%% md
+### Init Session
+#%%
+session_num = '000'
+#%%
+outputs_folder_path_csv = 'output_files_PSO_Benchmark/csv'
+#%% md
+## Run Benchmark
+#%% md
+### Benchmark Constants
+#%%
+FUNCTIONS = ['sphere', 'rastrigin', 'rosenbrock', 'ackley']
+DIMS = [2, 10, 30]
+SWARM_SIZES = [8, 32, 256]
+N_JOBS = [1, 4]
+
+MAX_GENERATIONS = 50
+TARGET = 1e-2
+SEED = 0
+#%% md
+### Continuous Test Functions
+#%%
+df_continuous = run_benchmark_grid(FUNCTIONS, DIMS, SWARM_SIZES, N_JOBS, MAX_GENERATIONS, TARGET, mixed=False, seed=SEED)
+df_continuous
+#%% md
+### Mixed Integer/Categorical Test Functions
+#%%
+df_mixed = run_benchmark_grid(FUNCTIONS, DIMS, SWARM_SIZES, N_JOBS, MAX_GENERATIONS, TARGET, mixed=True, seed=SEED)
+df_mixed
+#%% md
+### Save Results
+#%%
+folder_exists_check(outputs_folder_path_csv, session_num, 'df_PSO_Benchmark')
+df_continuous.to_csv(file_name_builder(outputs_folder_path_csv, session_num, 'df_PSO_Benchmark_continuous', 'csv'))
+df_mixed.to_csv(file_name_builder(outputs_folder_path_csv, session_num, 'df_PSO_Benchmark_mixed', 'csv'))
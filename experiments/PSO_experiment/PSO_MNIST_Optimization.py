@@ -15,17 +15,17 @@ sys.path.insert(0, '../..')
 
 from utils.persistency.logger import Logger
 
-from utils.dataset.build_dataset import load_MNIST_data
+from utils.dataset.build_dataset import load_MNIST_data, load_MNIST_data_shared, load_MNIST_data_preloaded
 from utils.dataset.build_dataloader import init_data_loader
 
-from backend.pso_train_loop import pso_full_train_loop
+from backend.pso_train_loop import pso_full_train_loop, pso_batched_train_loop
 from utils.model.model_utils import init_model
 from utils.optimization.early_stopper import EarlyStopper
 from utils.optimization.regularizer import Regularizer
 from utils.misc.device import get_device
 from utils.model.model_utils import get_activation_fn, get_loss_fn, get_optimizer
 from experiments.PSO_experiment.backend.PSO import PSO, PSOTrial
-from experiments.PSO_experiment.backend.pso_utils import decode_hyperparameter, build_encoded_dict
+from experiments.PSO_experiment.backend.pso_utils import decode_hyperparameter, build_encoded_dict, LOG_SCALE, INT_SCALE
 from experiments.PSO_experiment.backend.pso_utils import ACTIVATION_FN_BOUNDS, OPTIMIZER_BOUNDS
 from experiments.PSO_experiment.backend.pso_runner import PSORunner
 from experiments.PSO_experiment.backend.pso_pruners import PSOMedianPruner
@@ -39,7 +39,17 @@ outputs_folder_path_txt = 'output_files_PSO_MNIST/txt'
 #%% md
 ## Load Data
 #%%
-train_dataset, val_dataset, test_dataset = load_MNIST_data('data_pso/')
+# 'standard': torchvision pipeline (default)
+# 'shared': decoded once into memory-mapped files that every joblib worker (n_jobs > 1) reads without copies
+# 'preloaded': opt-in, the whole dataset on the training device, for in-process runs (batched objective)
+DATA_MODE = 'standard'
+
+if DATA_MODE == 'shared':
+    train_dataset, val_dataset, test_dataset = load_MNIST_data_shared('data_pso/', 'data_pso/shared/')
+elif DATA_MODE == 'preloaded':
+    train_dataset, val_dataset, test_dataset = load_MNIST_data_preloaded('data_pso/', device=get_device())
+else:
+    train_dataset, val_dataset, test_dataset = load_MNIST_data('data_pso/')
 #%% md
 ## Optuna Optimization
 #%% md
@@ -119,20 +129,78 @@ def objective(trial: PSOTrial, logger: Logger):
                                       trial=trial)
 
     return optim_score
+#%%
+def batched_objective(trials: list[PSOTrial], logger: Logger):
+    models, optimizer_strs, learning_rates, early_stoppers = [], [], [], []
+
+    for trial in trials:
+        # Define Hyperparameters - Structure HPs - Activation Function
+        activation = decode_hyperparameter(build_encoded_dict(trial, ACTIVATION_FN_BOUNDS))
+
+        # Define Hyperparameters - Structure HPs - Network Architecture (Width)
+        network_architecture = [28 * 28]
+        for i in range(3):
+            layer_width = round(trial.hyperparameters[f'hidden_layer_n{i+1}_size'])
+            if layer_width >= 8:
+                network_architecture.append(layer_width)
+        network_architecture.append(10)
+        trial.set_user_attr('network', network_architecture)
+
+        # Define Hyperparameters - Training HPs - Optimizer and Learning Rate
+        optimizer_str = decode_hyperparameter(build_encoded_dict(trial, OPTIMIZER_BOUNDS))
+        optimizer_strs.append(optimizer_str)
+        learning_rates.append(trial.hyperparameters['learning_rate'])
+
+        trial.set_user_attr('categorical', {activation, 'CrossEntropy', optimizer_str})
+
+        # Init Model and Early Stopper (one per particle)
+        model_extra_args = {'network_architecture': network_architecture, 'activation': get_activation_fn(activation)}
+        models.append(init_model(model_str='MLP', extra_args=model_extra_args))
+        early_stoppers.append(EarlyStopper(patience=5, mode="maximize"))
+
+
+    # Init DataLoaders (shared by the whole generation)
+    batch_size = 16
+    train_loader = init_data_loader(train_dataset, batch_size=batch_size)
+    val_loader = init_data_loader(val_dataset, batch_size=batch_size)
+    test_loader = init_data_loader(test_dataset, batch_size=batch_size)
+
+    # Init Loss
+    loss_fn = get_loss_fn(loss_str='CrossEntropy')
+
+    # Init Regularizer
+    regularizer = Regularizer(lambda_tot_widths=0.4, max_depth=3, max_width=128)
+
+    # Perform Batched Training (the whole generation in one forward/backward pass per batch)
+    optim_scores = pso_batched_train_loop(max_epochs=30,
+                                          train_loader=train_loader, val_loader=val_loader, test_loader=test_loader,
+                                          models=models,
+                                          loss_fn=loss_fn,
+                                          optimizer_strs=optimizer_strs,
+                                          learning_rates=learning_rates,
+                                          early_stoppers=early_stoppers,
+                                          regularizer=regularizer,
+                                          logger=logger,
+                                          trials=trials)
+
+    return optim_scores
 #%% md
 #### PSO Constants
 #%%
 ATTRS = ('generation', 'particle_id', 'hp_num_hidden_layer', 'score', 'user_attrs_epochs', 'user_attrs_network', 'user_attr_accuracy', 'user_attr_precision', 'user_attr_recall', 'user_attr_f1', 'state', 'duration', 'hp_hidden_layer_n1_size', 'hp_hidden_layer_n2_size', 'hp_hidden_layer_n3_size', 'hp_learning_rate' 'datetime_start', 'datetime_complete')
 #%%
 DIRECTION = 'maximize'
+
+# Opt-in: batched_objective trains the whole generation in one pass per batch, in this process (n_jobs is not used)
+BATCHED_OBJECTIVE = False
 #%% md
 ### Define Study
 #%%
 DYNAMIC_HPs = {
     # 'num_hidden_layer': [3, 3],
-    'hidden_layer_n1_size': [0, 128],
-    'hidden_layer_n2_size': [0, 128],
-    'hidden_layer_n3_size': [0, 128],
+    'hidden_layer_n1_size': [0, 128, INT_SCALE],
+    'hidden_layer_n2_size': [0, 128, INT_SCALE],
+    'hidden_layer_n3_size': [0, 128, INT_SCALE],
 
     **ACTIVATION_FN_BOUNDS,
 
@@ -140,12 +208,12 @@ DYNAMIC_HPs = {
     # **LOSS_FN_BOUNDS,
     **OPTIMIZER_BOUNDS,
 
-    'learning_rate': [1e-4, 1e-2]
+    'learning_rate': [1e-4, 1e-2, LOG_SCALE]
 }
 #%%
 pso_pruner = PSOMedianPruner(n_startup_generations=3, n_warmup_steps=4, interval_steps=4, min_trials_per_step=4)
 #%%
-pso = PSO(objective_fn=objective, hps_bounds=DYNAMIC_HPs, num_particles=32, max_generations=10, pruner=None)
+pso = PSO(objective_fn=batched_objective if BATCHED_OBJECTIVE else objective, hps_bounds=DYNAMIC_HPs, num_particles=32, max_generations=10, pruner=None)
 #%% md
 ### Run Optimization
 #%%
@@ -153,6 +221,6 @@ pso_runner = PSORunner(path_csv=outputs_folder_path_csv,
                        path_txt=outputs_folder_path_txt,
                        session_num=session_num,
                        n_jobs=-1,
-                       metric_to_follow='accuracy', attrs=None)
+                       metric_to_follow='accuracy', attrs=None, batched=BATCHED_OBJECTIVE)
 #%%
 pso_runner(pso, 'PSO_Optimization_MNIST')
\ No newline at end of file
@@ -26,10 +26,11 @@ from utils.optimization.regularizer import Regularizer_WeedMapping
 from utils.misc.device import get_device
 from utils.model.model_utils import get_loss_fn, get_optimizer
 from experiments.PSO_experiment.backend.PSO import PSO, PSOTrial
-from experiments.PSO_experiment.backend.pso_utils import decode_hyperparameter, build_encoded_dict
+from experiments.PSO_experiment.backend.pso_utils import decode_hyperparameter, build_encoded_dict, LOG_SCALE
 from experiments.PSO_experiment.backend.pso_utils import BACKBONE_BOUNDS, OPTIMIZER_BOUNDS
 from experiments.PSO_experiment.backend.pso_runner import PSORunner
 from experiments.PSO_experiment.backend.pso_pruners import PSOMedianPruner
+from utils.optimization.fidelity import FidelitySchedule
 #%% md
 ### Init Session
 #%%
@@ -76,8 +77,8 @@ def objective(trial: PSOTrial, logger: Logger):
     loss_gamma = 2.0
     loss_weight = [0.06, 1.0, 1.7]
 
-    # Define Hyperparameters - Max Epochs
-    max_epochs = 30
+    # Define Hyperparameters - Max Epochs (Budget Assigned by the Fidelity Schedule)
+    max_epochs = trial.fidelity if trial.fidelity is not None else 30
 
 
     # Init DataLoaders
@@ -130,7 +131,7 @@ DYNAMIC_HPs = {
     # 'batch_size_train': [4, 8],
     # 'batch_size_val': [6, 12],
 
-    'learning_rate': [1e-4, 1e-2],
+    'learning_rate': [1e-4, 1e-2, LOG_SCALE],
     **OPTIMIZER_BOUNDS,
 
     # 'loss_gamma': [0.5, 5.0],
@@ -141,7 +142,12 @@ DYNAMIC_HPs = {
 #%%
 pso_pruner = PSOMedianPruner(n_startup_generations=3, n_warmup_steps=4, interval_steps=4, min_trials_per_step=4)
 #%%
-pso = PSO(objective_fn=objective, hps_bounds=DYNAMIC_HPs, num_particles=8, max_generations=10, pruner=None)
+# Opt-in: multi-fidelity, early generations train on fewer epochs (every particle trains for 30 epochs otherwise)
+MULTI_FIDELITY = False
+
+fidelity_schedule = FidelitySchedule(min_fidelity=3, max_fidelity=30, eta=3) if MULTI_FIDELITY else None
+#%%
+pso = PSO(objective_fn=objective, hps_bounds=DYNAMIC_HPs, num_particles=8, max_generations=10, pruner=None, fidelity_schedule=fidelity_schedule)
 #%% md
 ### Run Optimization
 #%%
@@ -1,99 +1,540 @@
 import copy
+import itertools
+import os
+import pickle
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
 from datetime import datetime
+from time import perf_counter
 
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
+from joblib.externals.loky import ProcessPoolExecutor
 
+from experiments.PSO_experiment.backend.pso_utils import encode_bounds, decode_position
+from utils.optimization.topologies import get_topology
 
-class Particle:
-    def __init__(self, bounds, particle_id):
-        self.particle_id = particle_id
 
-        self.position = np.random.uniform(bounds[:, 0], bounds[:, 1])
-        self.velocity = np.random.uniform(-1, 1, size=bounds.shape[0])
-        self.personal_best_position = np.copy(self.position)
-        self.personal_best_score = -np.inf
+class Swarm:
+    def __init__(self, bounds, num_particles, topology=None):
+        self.bounds = bounds
+        self.num_particles = num_particles
+        self.dims = bounds.shape[0]
+        self.topology = get_topology(topology)
+
+        self.particle_ids = np.arange(1, num_particles + 1)
+        self.positions = np.random.uniform(bounds[:, 0], bounds[:, 1], size=(num_particles, self.dims))
+        self.velocities = np.random.uniform(-1, 1, size=(num_particles, self.dims))
+        self.personal_best_positions = np.copy(self.positions)
+        self.personal_best_scores = np.full(num_particles, -np.inf)
+
+    def update_personal_bests(self, scores):
+        improved = scores > self.personal_best_scores
+        self.personal_best_scores[improved] = scores[improved]
+        self.personal_best_positions[improved] = self.positions[improved]
+        return improved
+
+    def update_velocities(self, global_best_position, w, c1, c2):
+        r1 = np.random.uniform(0, 1.5, size=self.velocities.shape)
+        r2 = np.random.uniform(0, 1.5, size=self.velocities.shape)
+
+        social_best_positions = self.topology.best_positions(self.personal_best_positions, self.personal_best_scores, global_best_position)
+
+        cognitive_velocities = c1 * r1 * (self.personal_best_positions - self.positions)
+        social_velocities = c2 * r2 * (social_best_positions - self.positions)
+
+        self.velocities *= w
+        self.velocities += cognitive_velocities
+        self.velocities += social_velocities
+
+    def update_positions(self):
+        self.positions += self.velocities
+        np.clip(self.positions, self.bounds[:, 0], self.bounds[:, 1], out=self.positions)
+
+    def step(self, global_best_position, w, c1, c2):
+        self.update_velocities(global_best_position, w, c1, c2)
+        self.update_positions()
+        self.topology.next_generation()
+
+    def update_personal_best(self, index, score):
+        if score > self.personal_best_scores[index]:
+            self.personal_best_scores[index] = score
+            self.personal_best_positions[index] = self.positions[index]
+            return True
+        return False
 
-    def update_velocity(self, global_best_position, w, c1, c2):
-        r1 = np.random.uniform(0, 1.5, size=self.velocity.shape)
-        r2 = np.random.uniform(0, 1.5, size=self.velocity.shape)
+    def step_particle(self, index, global_best_position, w, c1, c2):
+        r1 = np.random.uniform(0, 1.5, size=self.dims)
+        r2 = np.random.uniform(0, 1.5, size=self.dims)
 
-        cognitive_velocity = c1 * r1 * (self.personal_best_position - self.position)
-        social_velocity = c2 * r2 * (global_best_position - self.position)
+        social_best_position = self.topology.best_position(index, self.personal_best_positions, self.personal_best_scores, global_best_position)
 
-        self.velocity = w * self.velocity + cognitive_velocity + social_velocity
+        cognitive_velocity = c1 * r1 * (self.personal_best_positions[index] - self.positions[index])
+        social_velocity = c2 * r2 * (social_best_position - self.positions[index])
 
-    def update_position(self, bounds):
-        self.position += self.velocity
-        self.position = np.clip(self.position, bounds[:, 0], bounds[:, 1])
+        self.velocities[index] = w * self.velocities[index] + cognitive_velocity + social_velocity
+        self.positions[index] = np.clip(self.positions[index] + self.velocities[index], self.bounds[:, 0], self.bounds[:, 1])
 
 
 class PSO:
-    def __init__(self, objective_fn, hps_bounds, num_particles, max_generations, pruner=None):
+    def __init__(self, objective_fn, hps_bounds, num_particles, max_generations, pruner=None, checkpoint_path=None, checkpoint_interval=1, evaluation_cache=None, topology=None, fidelity_schedule=None, surrogate=None):
         self.objective_fn = objective_fn
 
-        self.hps = hps_bounds
-        self.bounds = np.array(list(self.hps.values()))
-        self.hps = {key: i for i, key in enumerate(self.hps.keys())}
+        self.hps_bounds = hps_bounds
+        self.bounds = encode_bounds(hps_bounds)     # Particle space, see pso_utils for log and integer scales
+        self.hps = {key: i for i, key in enumerate(hps_bounds.keys())}
 
         self.num_particles = num_particles
         self.max_generations = max_generations
 
         self.pruner = pruner
+        self.evaluation_cache = evaluation_cache
+        self.fidelity_schedule = fidelity_schedule
+        self.surrogate = surrogate
 
         self.pso_stopper = PSOStopping(tolerance=0.005, patience=5)
 
-        self.swarm = [Particle(self.bounds, particle_id=i+1) for i in range(self.num_particles)]
+        self.swarm = Swarm(self.bounds, self.num_particles, topology=topology)
         self.global_best_score = -np.inf
         self.global_best_position = None
 
         self.trials_list = []
         self.best_trial = None
 
-    def optimize(self, n_jobs=1, logger=None):
+        self.current_generation = 0
+        self.is_stopped = False
+        self._asked_trials = {}
+        self._told_trials = {}
+        self._superseded_trials = []    # Lower-fidelity trials of the particles promoted in the current generation
+        self._rung_fidelity = None
+        self._particle_generations = None
+        self._generation_started = False   # Pruner activated and positions screened for the current generation
+
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+
+        self.worker_utilization = None
+
+    def optimize(self, n_jobs=1, logger=None, asynchronous=False, process_pool=False, batched=False):
+        start_time = perf_counter()
+        first_trial_index = len(self.trials_list)
+
+        if batched:
+            self._optimize_batched(logger)
+        elif asynchronous or process_pool:
+            n_workers = effective_n_jobs(n_jobs)
+            with self._get_executor(n_workers) as executor:
+                if asynchronous:
+                    self._optimize_async(executor, n_workers, logger)
+                else:
+                    self._optimize_process_pool(executor, logger)
+        else:
+            self._optimize_sync(n_jobs, logger)
+
+        if not batched:     # Batched trials share the whole generation time, so the per-trial durations overlap
+            self._update_worker_utilization(n_jobs, first_trial_index, perf_counter() - start_time)
 
-        for i in range(self.max_generations):
+        if self.is_stopped:
+            logger.log(f"\n\n{'=':=<50}\nPSO Process Early-Stopped at Generation n° {self.current_generation}\n{'=':=<50}\n\n")
 
+        return self.position_to_hps_map(self.global_best_position), self.global_best_score
+
+    def _optimize_sync(self, n_jobs, logger):
+        while not self.is_finished():
+            trials = self._tell_cached(self.ask(), logger)
+
+            results = Parallel(n_jobs)(delayed(self.process_particle)(trial, logger) for trial in trials)
+
+            for current_trial, fitness in results:
+                self._store_cached(current_trial, fitness)
+                self.tell(current_trial, fitness)
+
+    def _optimize_batched(self, logger):
+        # The objective receives the whole generation (list of trials) and returns one score per trial
+        while not self.is_finished():
+            trials = self.ask()
+            if not trials:
+                continue
+
+            # Same cache lookup and store as the per-trial paths: only the uncached trials are trained
+            start_time = datetime.now()
+            for current_trial in trials:
+                current_trial.datetime_start = start_time
+            pending_trials = self._tell_cached(trials, logger)
+
+            scores = self.objective_fn(pending_trials, logger) if pending_trials else []
+
+            for current_trial, fitness in zip(pending_trials, scores):
+                current_trial.complete_trail(score=fitness)
+                self._store_cached(current_trial, fitness)
+                self.tell(current_trial, fitness)
+
+    def _optimize_process_pool(self, executor, logger):
+        while not self.is_finished():
+            trials = self._tell_cached(self.ask(), logger)
+
+            for current_trial, fitness in executor.map(_evaluate_trial, trials, itertools.repeat(logger)):
+                self._store_cached(current_trial, fitness)
+                self.tell(current_trial, fitness)
+
+    def _optimize_async(self, executor, n_workers, logger):
+        if self._particle_generations is None:
+            self._particle_generations = np.full(self.num_particles, self.current_generation)
+        particle_generations = self._particle_generations
+        ready_particles = deque(index for index in range(self.num_particles) if particle_generations[index] < self.max_generations)
+        running_trials = {}
+        n_completed = 0
+
+        while running_trials or (ready_particles and not self.is_stopped):
+            completed_trials = []
+            while ready_particles and (len(running_trials) < n_workers) and (not self.is_stopped):
+                index = ready_particles.popleft()
+
+                if self.pruner is not None:
+                    self.pruner.active_pruning(particle_generations[index])
+                self._screen_particle(index)
+
+                current_trial = self._build_trial(index, generation=particle_generations[index]+1,
+                                                  fidelity=self._get_rank_fidelity(index, particle_generations[index]+1))
+                cached_score = self._lookup_cached(current_trial, logger)
+                if cached_score is not None:
+                    # Completed without a worker: told before anything else is submitted, so the particle moves on
+                    completed_trials.append((index, current_trial, cached_score))
+                    break
+                running_trials[executor.submit(_evaluate_trial, current_trial, logger)] = index
+
+            if running_trials:
+                done_trials, _ = wait(running_trials, timeout=0 if completed_trials else None, return_when=FIRST_COMPLETED)
+                for future in done_trials:
+                    current_trial, fitness = future.result()
+                    self._store_cached(current_trial, fitness)
+                    completed_trials.append((running_trials.pop(future), current_trial, fitness))
+
+            for index, current_trial, fitness in completed_trials:
+                self._tell_async(index, current_trial, fitness)
+
+                particle_generations[index] += 1
+                if particle_generations[index] < self.max_generations:
+                    ready_particles.append(index)
+
+                n_completed += 1
+                if n_completed % self.num_particles == 0:
+                    self.swarm.topology.next_generation()
+                    self.current_generation = int(particle_generations.min())
+                    if self.pso_stopper.should_stop(self.global_best_score):
+                        self.is_stopped = True
+                    self._periodic_checkpoint()
+
+        self.current_generation = int(particle_generations.min())
+        self._periodic_checkpoint()
+
+    def _get_executor(self, n_workers):
+        # The objective (and the datasets it captures) is sent once per worker, not once per trial.
+        # A pool of its own, shut down after the run: joblib's Parallel cannot reuse loky's global executor
+        return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(self.objective_fn,))
+
+    # The evaluation cache is looked up and filled in this process only: the workers would evaluate on copies of it
+    # that are thrown away, so every mode (and both backends) trains only the trials the cache has not seen
+    def _lookup_cached(self, trial, logger):
+        if self.evaluation_cache is None:
+            return None
+        cached_score = self.evaluation_cache.lookup(trial, logger)
+        if cached_score is not None:
+            trial.complete_trail(score=cached_score)
+        return cached_score
+
+    def _tell_cached(self, trials, logger):
+        # Tells the cached trials right away and returns the ones left to evaluate
+        pending_trials = []
+        for current_trial in trials:
+            cached_score = self._lookup_cached(current_trial, logger)
+            if cached_score is None:
+                pending_trials.append(current_trial)
+            else:
+                self.tell(current_trial, cached_score)
+        return pending_trials
+
+    def _store_cached(self, trial, fitness):
+        if self.evaluation_cache is not None:
+            self.evaluation_cache.store(trial, fitness)
+
+    def _tell_async(self, index, current_trial, fitness):
+        self.trials_list.append(current_trial)
+
+        if self.surrogate is not None:
+            self.surrogate.add(self.swarm.positions[index], fitness)
+
+        self.swarm.update_personal_best(index, fitness)
+
+        if fitness > self.global_best_score:
+            self.global_best_score = fitness
+            self.global_best_position = np.copy(self.swarm.positions[index])
+            self.best_trial = copy.deepcopy(current_trial)
+
+        i = current_trial.generation - 1
+        w = self.inertia_factor_update(current_iter=i)
+        c1 = self.cognitive_factor_update(current_iter=i)
+        c2 = self.social_factor_update(current_iter=i)
+        self.swarm.step_particle(index, self.global_best_position, w, c1, c2)
+
+    def _get_rank_fidelity(self, index, generation):
+        if self.fidelity_schedule is None:
+            return None
+        rank = self.fidelity_schedule.rank(self.swarm.personal_best_scores, index)
+        return self.fidelity_schedule.rank_fidelity(generation, rank, self.num_particles)
+
+    def _update_worker_utilization(self, n_jobs, first_trial_index, wall_time):
+        # At most one trial per particle runs at a time, so workers beyond the swarm size are never busy
+        busy_time = sum(trial.duration.total_seconds() for trial in self.trials_list[first_trial_index:])
+        n_workers = min(effective_n_jobs(n_jobs), self.num_particles)
+        self.worker_utilization = busy_time / (n_workers * wall_time)
+
+    def ask(self):
+        if self.is_finished():
+            return []
+
+        skipped = None
+        if not self._generation_started:
+            self._generation_started = True
             if self.pruner is not None:
-                self.pruner.active_pruning(i)
+                self.pruner.active_pruning(self.current_generation)
+            skipped = self._screen_positions()
+
+        if (self.fidelity_schedule is not None) and (self._rung_fidelity is None):
+            self._rung_fidelity = self.fidelity_schedule.base_fidelity(self.current_generation+1)
+
+        new_trials = {}
+        for index, particle_id in enumerate(self.swarm.particle_ids):
+            if int(particle_id) not in self._asked_trials:
+                new_trials[int(particle_id)] = self._build_trial(index, generation=self.current_generation+1, fidelity=self._rung_fidelity)
+        self._asked_trials.update(new_trials)
+
+        if skipped is not None:
+            for index in np.flatnonzero(skipped):
+                skipped_trial = new_trials.pop(int(self.swarm.particle_ids[index]))
+                skipped_trial.skip_trial()
+                self.tell(skipped_trial, skipped_trial.score)
+
+        return list(new_trials.values())
+
+    def _screen_positions(self):
+        # Surrogate pre-screening: positions predicted to be clearly poor are replaced or skipped before any training.
+        # Particles already told in this generation (restored from a checkpoint) keep their evaluated positions.
+        if (self.surrogate is None) or (not self.surrogate.is_ready()):
+            return None
+        indexes = np.array([index for index, particle_id in enumerate(self.swarm.particle_ids)
+                            if int(particle_id) not in self._told_trials], dtype=int)
+        skipped = np.zeros(self.num_particles, dtype=bool)
+        if len(indexes) == 0:
+            return skipped
+        positions, skipped[indexes] = self.surrogate.screen(self.swarm.positions[indexes], self.bounds)
+        self.swarm.positions[indexes] = positions
+        return skipped
+
+    def _screen_particle(self, index):
+        # Steady-state mode has no generation barrier where a trial could be skipped, so positions are only replaced
+        if (self.surrogate is None) or (not self.surrogate.is_ready()) or (self.surrogate.mode == 'skip'):
+            return
+        positions, _ = self.surrogate.screen(self.swarm.positions[index:index+1], self.bounds)
+        self.swarm.positions[index] = positions[0]
+
+    def _build_trial(self, index, generation, fidelity=None):
+        return PSOTrial(particle_id=int(self.swarm.particle_ids[index]),
+                        generation=int(generation),
+                        hyperparameters=self.position_to_hps_map(self.swarm.positions[index]),
+                        pruner=self.pruner,
+                        fidelity=fidelity,
+                        position=self.swarm.positions[index])
+
+    def tell(self, trial, score):
+        if (trial.generation != self.current_generation+1) or (trial.particle_id not in self._asked_trials):
+            raise ValueError(f"Trial Gen n°{trial.generation} - Particle n°{trial.particle_id} was not asked in the current generation.")
+        if trial.particle_id in self._told_trials:
+            raise ValueError(f"Trial Gen n°{trial.generation} - Particle n°{trial.particle_id} was already told.")
+
+        if trial.state is None:
+            trial.complete_trail(score=score)
+        self._told_trials[trial.particle_id] = (trial, score)
+
+        if (len(self._told_trials) == self.num_particles) and (not self._promote_trials()):
+            self._end_generation()
+
+    def _promote_trials(self):
+        # Successive halving inside the generation: the best 1/eta of the current rung is evaluated again with a larger budget
+        if self.fidelity_schedule is None:
+            return False
+
+        next_fidelity = self.fidelity_schedule.next_fidelity(self._rung_fidelity)
+        rung_trials = [(particle_id, score) for particle_id, (trial, score) in self._told_trials.items()
+                       if (trial.fidelity == self._rung_fidelity) and (trial.state == 'COMPLETE')]
+        if (next_fidelity is None) or (not rung_trials):
+            return False
+
+        rung_trials.sort(key=lambda item: item[1], reverse=True)
+        for particle_id, _ in rung_trials[:self.fidelity_schedule.n_promoted(len(rung_trials))]:
+            superseded_trial, _ = self._told_trials.pop(particle_id)
+            self._superseded_trials.append(superseded_trial)
+            del self._asked_trials[particle_id]
+
+        self._rung_fidelity = next_fidelity
+        return True
+
+    def is_finished(self):
+        return self.is_stopped or (self.current_generation >= self.max_generations)
 
-            results = Parallel(n_jobs)(delayed(self.process_particle)(particle, i, logger) for particle in self.swarm)
+    def _end_generation(self):
+        i = self.current_generation
 
-            for current_trial, fitness, particle in results:
-                self.trials_list.append(current_trial)
+        scores = np.empty(self.num_particles)
+        generation_trials = []
+        self.trials_list.extend(self._superseded_trials)
+        for index, particle_id in enumerate(self.swarm.particle_ids):
+            current_trial, fitness = self._told_trials[int(particle_id)]
+            self.trials_list.append(current_trial)
+            generation_trials.append(current_trial)
+            scores[index] = fitness
 
-                if fitness > self.global_best_score:
-                    self.global_best_score = fitness
-                    self.global_best_position = np.copy(particle.position)
-                    self.best_trial = copy.deepcopy(current_trial)
+        self._asked_trials = {}
+        self._told_trials = {}
+        self._superseded_trials = []
+        self._rung_fidelity = None
+        self._generation_started = False
 
-            if self.pso_stopper.should_stop(self.global_best_score):
-                logger.log(f"\n\n{'=':=<50}\nPSO Process Early-Stopped at Generation n° {i+1}\n{'=':=<50}\n\n")
-                break
+        if self.surrogate is not None:
+            self.surrogate.add(self.swarm.positions, scores)
 
+        self.swarm.update_personal_bests(scores)
+
+        best_index = np.argmax(scores)
+        if scores[best_index] > self.global_best_score:
+            self.global_best_score = scores[best_index]
+            self.global_best_position = np.copy(self.swarm.positions[best_index])
+            self.best_trial = copy.deepcopy(generation_trials[best_index])
+
+        self.current_generation += 1
+
+        if self.pso_stopper.should_stop(self.global_best_score):
+            self.is_stopped = True
+        else:
             w = self.inertia_factor_update(current_iter=i)
             c1 = self.cognitive_factor_update(current_iter=i)
             c2 = self.social_factor_update(current_iter=i)
-            for particle in self.swarm:
-                particle.update_velocity(self.global_best_position, w, c1, c2)
-                particle.update_position(self.bounds)
+            self.swarm.step(self.global_best_position, w, c1, c2)
+
+        self._periodic_checkpoint()
+
+    def _periodic_checkpoint(self):
+        if self.checkpoint_path is None:
+            return
+        if self.is_finished() or (self.current_generation % self.checkpoint_interval == 0):
+            self.save_checkpoint()
+
+    def save_checkpoint(self, path=None):
+        path = path if path is not None else self.checkpoint_path
+
+        state = {
+            'hps': self.hps,
+            'bounds': self.bounds,
+            'num_particles': self.num_particles,
+            'max_generations': self.max_generations,
+            'swarm': self.swarm,
+            'global_best_score': self.global_best_score,
+            'global_best_position': self.global_best_position,
+            'trials_list': [copy.deepcopy(trial) for trial in self.trials_list],
+            'best_trial': self.best_trial,
+            'pso_stopper': self.pso_stopper,
+            'pruner': self.pruner,
+            'stats_offsets': self._get_stats_offsets(),
+            'surrogate': self.surrogate,
+            'current_generation': self.current_generation,
+            'is_stopped': self.is_stopped,
+            'told_trials': {key: (copy.deepcopy(trial), score) for key, (trial, score) in self._told_trials.items()},
+            'superseded_trials': [copy.deepcopy(trial) for trial in self._superseded_trials],
+            'rung_fidelity': self._rung_fidelity,
+            'particle_generations': self._particle_generations,
+            'generation_started': self._generation_started,
+            'rng_state': np.random.get_state(),
+        }
 
-        return self.position_to_hps_map(self.global_best_position), self.global_best_score
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as fout:
+            pickle.dump(state, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temp_path, path)
+        return path
+
+    def _get_stats_offsets(self):
+        if self.pruner is None:
+            return {}
+        return {store.path: store.file_offset() for store in self.pruner.get_stats_stores() if store.path is not None}
+
+    def _truncate_stats(self, stats_offsets):
+        # Reports appended to the shared stats files after the checkpoint belong to trials that will run again
+        if self.pruner is None:
+            return
+        for store in self.pruner.get_stats_stores():
+            if store.path in stats_offsets:
+                store.truncate(stats_offsets[store.path])
+
+    def resume(self, path=None):
+        path = path if path is not None else self.checkpoint_path
+        if path is None:
+            raise ValueError("No checkpoint to resume from: pass a path or set checkpoint_path.")
+        with open(path, 'rb') as fin:
+            state = pickle.load(fin)
+
+        if (state['hps'] != self.hps) or (not np.array_equal(state['bounds'], self.bounds)):
+            raise ValueError(f"Checkpoint {path} was saved with different hyperparameters bounds.")
+
+        self.num_particles = state['num_particles']
+        self.max_generations = state['max_generations']
+        self.swarm = state['swarm']
+        self.global_best_score = state['global_best_score']
+        self.global_best_position = state['global_best_position']
+        self.trials_list = state['trials_list']
+        self.best_trial = state['best_trial']
+        self.pso_stopper = state['pso_stopper']
+        self.pruner = state['pruner'] if state['pruner'] is not None else self.pruner
+        self._truncate_stats(state.get('stats_offsets', {}))
+        self.surrogate = state['surrogate'] if state['surrogate'] is not None else self.surrogate
+        self.current_generation = state['current_generation']
+        self.is_stopped = state['is_stopped']
+        self._told_trials = state['told_trials']
+        self._asked_trials = {key: trial for key, (trial, score) in self._told_trials.items()}
+        self._superseded_trials = state['superseded_trials']
+        self._rung_fidelity = state['rung_fidelity']
+        self._particle_generations = state['particle_generations']
+        self._generation_started = state.get('generation_started', False)
+        np.random.set_state(state['rng_state'])
+
+        if self.checkpoint_path is None:
+            self.checkpoint_path = path
+
+        self._restore_generation(seed_surrogate=(state['surrogate'] is None) and (self.surrogate is not None))
+        return self
+
+    def _restore_generation(self, seed_surrogate):
+        # Same steps as a run that never stopped: the pruner is activated, a surrogate not saved in the checkpoint
+        # learns the restored trials (and screens the particles still to be asked), a fully told generation is closed
+        if self.pruner is not None:
+            self.pruner.active_pruning(self.current_generation)
 
-    def process_particle(self, particle, i, logger):
-        current_trial = PSOTrial(particle_id=particle.particle_id,
-                                 generation=i+1,
-                                 hyperparameters=self.position_to_hps_map(particle.position),
-                                 pruner=self.pruner)
-        fitness = self.objective_fn(current_trial, logger)
-        current_trial.complete_trail(score=fitness)
+        if seed_surrogate:
+            restored_trials = self.trials_list + [trial for trial, _ in self._told_trials.values()]
+            for trial in restored_trials:
+                if (getattr(trial, 'position', None) is not None) and (trial.score is not None):
+                    self.surrogate.add(trial.position, trial.score)
+            self._generation_started = False
 
-        if fitness > particle.personal_best_score:
-            particle.personal_best_score = fitness
-            particle.personal_best_position = np.copy(particle.position)
+        if (self._particle_generations is None) and (len(self._told_trials) == self.num_particles):
+            self._generation_started = True
+            if not self._promote_trials():
+                self._end_generation()
 
-        return current_trial, fitness, particle
+    def process_particle(self, trial, logger):
+        return _run_objective(self.objective_fn, trial, logger)
 
     def inertia_factor_update(self, current_iter):
         return (0.4 * ((current_iter - self.max_generations) / (self.max_generations ** 2))) + 0.4
@@ -105,7 +546,7 @@ class PSO:
         return (3 * (current_iter / self.max_generations)) + 0.5
 
     def position_to_hps_map(self, position):
-        return {key: position[self.hps[key]] for key in self.hps.keys()}
+        return decode_position(position, self.hps_bounds)
 
     def trials_dataframe(self, attrs=None):
         if attrs is not None:
@@ -113,11 +554,33 @@ class PSO:
         return pd.DataFrame([trial.to_dict() for trial in self.trials_list])
 
 
+_worker_objective_fn = None
+
+
+def _init_worker(objective_fn):
+    global _worker_objective_fn
+    _worker_objective_fn = objective_fn
+
+
+def _evaluate_trial(trial, logger):
+    return _run_objective(_worker_objective_fn, trial, logger)
+
+
+def _run_objective(objective_fn, trial, logger):
+    trial.datetime_start = datetime.now()
+    fitness = objective_fn(trial, logger)
+    trial.complete_trail(score=fitness)
+
+    return trial, fitness
+
+
 class PSOTrial:
-    def __init__(self, particle_id, generation, hyperparameters, pruner=None):
+    def __init__(self, particle_id, generation, hyperparameters, pruner=None, fidelity=None, position=None):
         self.particle_id = particle_id
         self.generation = generation
         self.hyperparameters = hyperparameters
+        self.fidelity = fidelity    # Epoch/data budget assigned by the FidelitySchedule, None means full budget
+        self.position = np.copy(position) if position is not None else None     # Encoded particle position
 
         self.datetime_start = datetime.now()
 
@@ -129,6 +592,7 @@ class PSOTrial:
         self.is_pruned = False
         self.pruner = pruner
         self.last_reported_step = 0
+        self.last_reported_score = None
         self.best_reported_score = -np.inf
 
         self.user_attrs = dict()
@@ -144,6 +608,10 @@ class PSOTrial:
         self.datetime_complete = datetime.now()
         self.duration = self.datetime_complete - self.datetime_start
 
+    def skip_trial(self):
+        self.complete_trail(score=-np.inf)
+        self.state = 'SKIPPED'
+
     def set_user_attr(self, key, value):
         self.user_attrs[key] = value
 
@@ -151,6 +619,7 @@ class PSOTrial:
         if self.pruner is not None:
             self.pruner.report(score, step)
             self.last_reported_step = step
+            self.last_reported_score = score
             if (self.best_reported_score is None) or (score > self.best_reported_score):
                 self.best_reported_score = score
 
@@ -166,6 +635,7 @@ class PSOTrial:
         return {
             'generation': self.generation,
             'particle_id': self.particle_id,
+            'fidelity': self.fidelity,
             'score': round(self.score, 4),
             **{f'user_attrs_{key}': self.user_attrs[key] for key in self.user_attrs},
             'state': self.state,
@@ -176,7 +646,8 @@ class PSOTrial:
         }
 
     def __deepcopy__(self, memo):
-        new_trial = PSOTrial(self.particle_id, self.generation, copy.deepcopy(self.hyperparameters, memo))
+        new_trial = PSOTrial(self.particle_id, self.generation, copy.deepcopy(self.hyperparameters, memo), fidelity=self.fidelity,
+                             position=getattr(self, 'position', None))
         new_trial.datetime_start = copy.deepcopy(self.datetime_start, memo)
         new_trial.score = self.score
         new_trial.state = self.state
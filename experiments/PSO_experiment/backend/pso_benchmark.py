@@ -0,0 +1,149 @@
+from time import perf_counter
+
+import numpy as np
+import optuna
+import pandas as pd
+from joblib import effective_n_jobs
+
+from experiments.PSO_experiment.backend.PSO import PSO, PSOTrial
+from experiments.PSO_experiment.backend.pso_utils import decode_hyperparameter, build_encoded_dict, INT_SCALE
+from utils.optuna_utils.pso_sampler import PSOSampler
+
+
+def sphere(x):
+    return np.sum(x ** 2)
+
+
+def rastrigin(x):
+    return 10 * len(x) + np.sum(x ** 2 - 10 * np.cos(2 * np.pi * x))
+
+
+def rosenbrock(x):
+    return np.sum(100 * (x[1:] - x[:-1] ** 2) ** 2 + (1 - x[:-1]) ** 2)
+
+
+def ackley(x):
+    return (-20 * np.exp(-0.2 * np.sqrt(np.mean(x ** 2)))
+            - np.exp(np.mean(np.cos(2 * np.pi * x))) + 20 + np.e)
+
+
+BENCHMARK_FUNCTIONS = {    # [function, low, high]
+    'sphere': [sphere, -5.12, 5.12],
+    'rastrigin': [rastrigin, -5.12, 5.12],
+    'rosenbrock': [rosenbrock, -2.048, 2.048],
+    'ackley': [ackley, -32.768, 32.768],
+}
+
+# Mixed variants: half of the dimensions are integers and a categorical picks an additive shift
+CATEGORICAL_SHIFTS = {'shift_0': 0.0, 'shift_1': 1.0, 'shift_2': 2.0}
+
+
+class _NullLogger:
+    def log(self, message):
+        pass
+
+
+class BenchmarkObjective:
+    def __init__(self, function_str, dims, mixed=False):
+        self.function_str = function_str
+        self.function, self.low, self.high = BENCHMARK_FUNCTIONS[function_str]
+        self.dims = dims
+        self.mixed = mixed
+        self.n_int_dims = dims // 2 if mixed else 0
+
+    def get_pso_bounds(self):
+        bounds = {f'x{i}': [int(np.ceil(self.low)), int(np.floor(self.high)), INT_SCALE] for i in range(self.n_int_dims)}
+        bounds.update({f'x{i}': [self.low, self.high] for i in range(self.n_int_dims, self.dims)})
+        if self.mixed:
+            bounds.update({key: [0, 1] for key in CATEGORICAL_SHIFTS.keys()})
+        return bounds
+
+    def evaluate(self, x, shift_str=None):
+        shift = CATEGORICAL_SHIFTS[shift_str] if shift_str is not None else 0.0
+        return self.function(np.asarray(x, dtype=float)) + shift
+
+    def __call__(self, trial, logger=None):
+        if isinstance(trial, PSOTrial):
+            x = [trial.hyperparameters[f'x{i}'] for i in range(self.dims)]
+            shift_str = decode_hyperparameter(build_encoded_dict(trial, CATEGORICAL_SHIFTS)) if self.mixed else None
+        else:
+            x = [trial.suggest_int(f'x{i}', int(np.ceil(self.low)), int(np.floor(self.high))) for i in range(self.n_int_dims)]
+            x += [trial.suggest_float(f'x{i}', self.low, self.high) for i in range(self.n_int_dims, self.dims)]
+            shift_str = trial.suggest_categorical('shift', list(CATEGORICAL_SHIFTS.keys())) if self.mixed else None
+
+        start_time = perf_counter()
+        score = -self.evaluate(x, shift_str)    # Both optimizers maximize
+        trial.set_user_attr('objective_time', perf_counter() - start_time)
+        return score
+
+
+def run_pso_benchmark(objective, num_particles, max_generations, n_jobs, target, **pso_kwargs):
+    pso = PSO(objective_fn=objective, hps_bounds=objective.get_pso_bounds(),
+              num_particles=num_particles, max_generations=max_generations, **pso_kwargs)
+
+    start_time = perf_counter()
+    pso.optimize(n_jobs=n_jobs, logger=_NullLogger())
+    wall_time = perf_counter() - start_time
+
+    scores = [trial.score for trial in pso.trials_list]
+    objective_time = sum(trial.user_attrs['objective_time'] for trial in pso.trials_list)
+    n_generations = max(trial.generation for trial in pso.trials_list)
+
+    return build_benchmark_record('PSO', objective, num_particles, n_jobs, target, scores, objective_time, wall_time, n_generations)
+
+
+def run_sampler_benchmark(objective, num_particles, max_generations, n_jobs, target, **sampler_kwargs):
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    sampler = PSOSampler(num_particles=num_particles, max_generations=max_generations, **sampler_kwargs)
+    study = optuna.create_study(direction='maximize', sampler=sampler)
+
+    start_time = perf_counter()
+    study.optimize(objective, n_trials=num_particles * max_generations, n_jobs=n_jobs)
+    wall_time = perf_counter() - start_time
+
+    trials = [trial for trial in study.trials if trial.value is not None]
+    scores = [trial.value for trial in trials]
+    objective_time = sum(trial.user_attrs['objective_time'] for trial in trials)
+
+    return build_benchmark_record('PSOSampler', objective, num_particles, n_jobs, target, scores, objective_time, wall_time, max_generations)
+
+
+def build_benchmark_record(optimizer_str, objective, num_particles, n_jobs, target, scores, objective_time, wall_time, n_generations):
+    n_workers = min(effective_n_jobs(n_jobs), num_particles)
+    values = -np.asarray(scores)
+    reached = np.flatnonzero(values <= target)
+
+    return {
+        'optimizer': optimizer_str,
+        'function': objective.function_str,
+        'mixed': objective.mixed,
+        'dims': objective.dims,
+        'num_particles': num_particles,
+        'n_jobs': n_jobs,
+        'generations': n_generations,
+        'evaluations': len(values),
+        'best_value': values.min(),
+        'evaluations_to_target': (reached[0] + 1) if len(reached) > 0 else None,
+        'wall_time': wall_time,
+        'time_per_generation': wall_time / n_generations,
+        'objective_time': objective_time,
+        'optimizer_overhead': max(wall_time - (objective_time / n_workers), 0.0),
+        'overhead_per_evaluation': max(wall_time - (objective_time / n_workers), 0.0) / len(values),
+    }
+
+
+def run_benchmark_grid(function_strs, dims_list, num_particles_list, n_jobs_list, max_generations, target,
+                       mixed=False, optimizers=('PSO', 'PSOSampler'), seed=None):
+    records = []
+    for function_str in function_strs:
+        for dims in dims_list:
+            objective = BenchmarkObjective(function_str, dims, mixed=mixed)
+            for num_particles in num_particles_list:
+                for n_jobs in n_jobs_list:
+                    if 'PSO' in optimizers:
+                        np.random.seed(seed)
+                        records.append(run_pso_benchmark(objective, num_particles, max_generations, n_jobs, target))
+                    if 'PSOSampler' in optimizers:
+                        np.random.seed(seed)
+                        records.append(run_sampler_benchmark(objective, num_particles, max_generations, n_jobs, target))
+    return pd.DataFrame(records)
@@ -1,6 +1,9 @@
-import numpy as np
+import binascii
+import math
+import os
 
 from experiments.PSO_experiment.backend.PSO import PSOTrial
+from utils.optimization.pruning_stats import PruningStatsStore
 
 
 class BasePSOPruner:
@@ -12,6 +15,14 @@ class BasePSOPruner:
         if generation >= self.n_startup_generations:
             self.is_pruning_active = True
 
+    def share_stats(self, stats_path):
+        # Pruners whose statistics must be seen by every worker process store them under stats_path
+        pass
+
+    def get_stats_stores(self):
+        # PruningStatsStore instances of the pruner, checkpointed and restored by PSO
+        return []
+
     def report(self, score, step):
         raise NotImplementedError
 
@@ -20,18 +31,24 @@ class BasePSOPruner:
 
 
 class PSOMedianPruner(BasePSOPruner):
-    def __init__(self, n_startup_generations, n_warmup_steps, interval_steps, min_trials_per_step):
+    def __init__(self, n_startup_generations, n_warmup_steps, interval_steps, min_trials_per_step, stats_path=None):
         super().__init__(n_startup_generations)
         self.n_warmup_steps = n_warmup_steps
         self.interval_steps = interval_steps
         self.min_trials_per_step = min_trials_per_step
 
-        self.reports_map = {}
+        # With a stats_path the reports of every worker process are shared through that file
+        self.pruning_stats = PruningStatsStore(stats_path)
+
+    def share_stats(self, stats_path):
+        if self.pruning_stats.path is None:
+            self.pruning_stats.share(stats_path)
+
+    def get_stats_stores(self):
+        return [self.pruning_stats]
 
     def report(self, score, step):
-        if step not in self.reports_map:
-            self.reports_map[step] = []
-        self.reports_map[step].append(score)
+        self.pruning_stats.report(score, step)
 
     def should_prune(self, trial: PSOTrial):
         if not self.is_pruning_active:
@@ -40,9 +57,113 @@ class PSOMedianPruner(BasePSOPruner):
             return False
         if trial.last_reported_step % self.interval_steps != 0:
             return False
-        if len(self.reports_map[trial.last_reported_step]) < self.min_trials_per_step:
+        if self.pruning_stats.count(trial.last_reported_step) < self.min_trials_per_step:
             return False
-        if trial.best_reported_score < np.median(self.reports_map[trial.last_reported_step]):
+        if trial.best_reported_score < self.pruning_stats.median(trial.last_reported_step):
             return True
         return False
 
+
+
+class PSOSuccessiveHalvingPruner(BasePSOPruner):
+    def __init__(self, n_startup_generations, min_resource=1, reduction_factor=3, min_early_stopping_rate=0, bootstrap_count=0,
+                 stats_path=None):
+        super().__init__(n_startup_generations)
+        self.min_resource = min_resource
+        self.reduction_factor = reduction_factor
+        self.min_early_stopping_rate = min_early_stopping_rate
+        self.bootstrap_count = bootstrap_count
+
+        # Rung values keyed on the rung index, shared through stats_path like the median pruner reports
+        self.rungs_stats = PruningStatsStore(stats_path)
+
+    def share_stats(self, stats_path):
+        if self.rungs_stats.path is None:
+            self.rungs_stats.share(stats_path)
+
+    def get_stats_stores(self):
+        return [self.rungs_stats]
+
+    def report(self, score, step):
+        pass    # Rung values are recorded by should_prune, which sees the whole trial
+
+    def should_prune(self, trial: PSOTrial):
+        rung = self.get_rung(trial.last_reported_step)
+        if rung is None:
+            return False
+
+        # Values are recorded during the startup generations too, so that the rungs are filled once pruning starts
+        rung_value = trial.last_reported_score
+        self.rungs_stats.report(rung_value, rung)
+
+        if not self.is_pruning_active:
+            return False
+
+        competing_values = self.rungs_stats.values(rung)
+        if len(competing_values) <= self.bootstrap_count:
+            return True
+
+        # Top 1/reduction_factor of the rung is promoted (the best one while the rung holds fewer values)
+        promotable_index = max((len(competing_values) // self.reduction_factor) - 1, 0)
+        return rung_value < competing_values[promotable_index]
+
+    def get_rung(self, step):
+        rung = 0
+        while True:
+            promotion_step = self.min_resource * (self.reduction_factor ** (self.min_early_stopping_rate + rung))
+            if promotion_step == step:
+                return rung
+            if promotion_step > step:
+                return None
+            rung += 1
+
+
+class PSOHyperbandPruner(BasePSOPruner):
+    def __init__(self, n_startup_generations, min_resource=1, max_resource=30, reduction_factor=3, bootstrap_count=0,
+                 stats_path=None):
+        super().__init__(n_startup_generations)
+        self.min_resource = min_resource
+        self.max_resource = max_resource
+        self.reduction_factor = reduction_factor
+
+        n_brackets = math.floor(math.log(max_resource / min_resource, reduction_factor)) + 1
+        self.brackets = [PSOSuccessiveHalvingPruner(n_startup_generations, min_resource, reduction_factor,
+                                                    min_early_stopping_rate=i, bootstrap_count=bootstrap_count,
+                                                    stats_path=self.get_bracket_stats_path(stats_path, i))
+                         for i in range(n_brackets)]
+
+        # Same allocation as Optuna: the aggressive brackets receive more trials
+        self.bracket_budgets = [math.ceil(n_brackets * (reduction_factor ** s) / (s + 1)) for s in reversed(range(n_brackets))]
+
+    def active_pruning(self, generation):
+        super().active_pruning(generation)
+        for bracket in self.brackets:
+            bracket.active_pruning(generation)
+
+    def share_stats(self, stats_path):
+        for bracket_id, bracket in enumerate(self.brackets):
+            bracket.share_stats(self.get_bracket_stats_path(stats_path, bracket_id))
+
+    def get_stats_stores(self):
+        return [store for bracket in self.brackets for store in bracket.get_stats_stores()]
+
+    def report(self, score, step):
+        pass
+
+    def should_prune(self, trial: PSOTrial):
+        return self.brackets[self.get_bracket_id(trial)].should_prune(trial)
+
+    @staticmethod
+    def get_bracket_stats_path(stats_path, bracket_id):
+        if stats_path is None:
+            return None
+        root, ext = os.path.splitext(stats_path)
+        return f'{root}_bracket{bracket_id}{ext}'
+
+    def get_bracket_id(self, trial: PSOTrial):
+        # Drawn again at every generation, so a particle does not stay in the same bracket for the whole study
+        n = binascii.crc32(f'{trial.generation}_{trial.particle_id}'.encode()) % sum(self.bracket_budgets)
+        for bracket_id, budget in enumerate(self.bracket_budgets):
+            n -= budget
+            if n < 0:
+                return bracket_id
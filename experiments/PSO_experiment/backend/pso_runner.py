@@ -1,3 +1,4 @@
+from joblib import effective_n_jobs
 from utils.persistency.file_name_builder import folder_exists_check, file_name_builder
 from utils.persistency.logger import Logger
 from experiments.PSO_experiment.backend.PSO import PSO
@@ -6,23 +7,38 @@ ATTRS = ('generation', 'particle_id', 'hp_num_hidden_layer', 'score', 'user_attr
 
 
 class PSORunner:
-    def __init__(self, path_csv, path_txt, session_num, n_jobs, metric_to_follow, attrs=ATTRS):
+    def __init__(self, path_csv, path_txt, session_num, n_jobs, metric_to_follow, attrs=ATTRS, asynchronous=False, process_pool=False, batched=False):
         self.path_csv = path_csv
         self.path_txt = path_txt
         self.session_num = session_num
         self.n_jobs = n_jobs
         self.metric_to_follow = metric_to_follow
         self.attrs = attrs
+        self.asynchronous = asynchronous
+        self.process_pool = process_pool
+        self.batched = batched
 
-    def __call__(self, pso_study: PSO, study_str: str):
+    def uses_worker_processes(self):
+        # Batched generations run in this process, every other mode evaluates in joblib/loky workers when parallel
+        if self.batched:
+            return False
+        return self.asynchronous or self.process_pool or (effective_n_jobs(self.n_jobs) > 1)
+
+    def __call__(self, pso_study: PSO, study_str: str, load=False):
         # Init Logger
-        folder_exists_check(self.path_csv, self.session_num, f'df_{study_str}')
-        folder_exists_check(self.path_txt, self.session_num, f'log_{study_str}')
+        if not load:
+            folder_exists_check(self.path_csv, self.session_num, f'df_{study_str}')
+            folder_exists_check(self.path_txt, self.session_num, f'log_{study_str}')
         logger_study = Logger(file_name_builder(self.path_txt, self.session_num, f'log_{study_str}', 'txt'))
 
-        # Run Optimization
+        # Resume and Run Optimization
         try:
-            pso_study.optimize(n_jobs=self.n_jobs, logger=logger_study)
+            if load:
+                pso_study.resume()
+            if (pso_study.pruner is not None) and self.uses_worker_processes():
+                # Worker processes only see each other's pruning statistics through a file
+                pso_study.pruner.share_stats(file_name_builder(self.path_txt, self.session_num, f'pruning_stats_{study_str}', 'bin'))
+            pso_study.optimize(n_jobs=self.n_jobs, logger=logger_study, asynchronous=self.asynchronous, process_pool=self.process_pool, batched=self.batched)
         except Exception as e:
             logger_study.err(e)
             return None
@@ -34,6 +50,12 @@ class PSORunner:
         logger_study.log(f"Best trial {self.metric_to_follow}-score: {pso_study.best_trial.user_attrs[self.metric_to_follow]}")
         logger_study.log(f"Best score:                {pso_study.best_trial.score}")
         logger_study.log(f"Best hyperparameters:      {pso_study.best_trial.hyperparameters}")
+        if pso_study.worker_utilization is not None:
+            logger_study.log(f"Worker utilization:        {pso_study.worker_utilization*100:>0.2f}%")
+        if pso_study.evaluation_cache is not None:
+            logger_study.log(f"Evaluation cache counters: {pso_study.evaluation_cache.get_counters()}")
+        if pso_study.surrogate is not None:
+            logger_study.log(f"Surrogate counters:        {pso_study.surrogate.get_counters()}")
 
         logger_study.end_log()
 
@@ -2,6 +2,10 @@ from torch import cuda
 
 from experiments.PSO_experiment.backend.PSO import PSOTrial
 from experiments.weed_mapping_experiment.backend.model.lawin_model import Lawin
+from utils.misc.device import get_device
+from utils.model.BatchedMLP import BatchedMLP
+from utils.training.batched_optimizer import BatchedOptimizer
+from utils.training.batched_step import batched_train_step, batched_eval_step
 from utils.training.eval_step import eval_step
 from utils.training.train_step import train_step
 
@@ -66,6 +70,90 @@ def pso_full_train_loop(max_epochs, train_loader, val_loader, test_loader, model
     return final_optim_score
 
 
+def pso_batched_train_loop(max_epochs, train_loader, val_loader, test_loader, models, loss_fn, optimizer_strs, learning_rates, early_stoppers, regularizer, logger, trials: list[PSOTrial]):
+
+    # Group Models by Depth (each group is trained as one BatchedMLP, padded to its largest widths)
+    groups = {}
+    for index, model in enumerate(models):
+        groups.setdefault(len(model.layer_sizes), []).append(index)
+    groups = list(groups.values())
+
+    batched_models = [BatchedMLP([models[index] for index in group]).to(get_device()) for group in groups]
+    optimizers = [BatchedOptimizer(batched_model.parameters(),
+                                   optimizer_strs=[optimizer_strs[index] for index in group],
+                                   learning_rates=[learning_rates[index] for index in group])
+                  for batched_model, group in zip(batched_models, groups)]
+    scores = [None] * len(models)
+
+    # Train Models
+    for epoch_index in range(max_epochs):
+        if not any(optimizer.active.any() for optimizer in optimizers):
+            break
+
+        # Training Step (shared batches, one forward/backward pass per group)
+        batched_train_step(train_loader, batched_models, loss_fn, optimizers)
+
+        for group, batched_model, optimizer in zip(groups, batched_models, optimizers):
+
+            # Evaluation Step (Intermediate)
+            val_losses, val_metrics = batched_eval_step(val_loader, batched_model, loss_fn)
+
+            for position, index in enumerate(group):
+                if not optimizer.active[position]:
+                    continue
+                val_metrics_processed = [i.item() for i in val_metrics[position]]
+
+                # Intermediate Optimization Score
+                optim_score = regularizer(score=val_metrics_processed[get_metric_to_follow(models[index])],
+                                          network_architecture=batched_model.get_network_architecture(position))
+
+                # Print Intermediate Evaluation
+                intermediate_reporting(val_loss=val_losses[position], val_metrics=val_metrics_processed,
+                                       intermediate_score=optim_score, epoch_index=epoch_index,
+                                       logger=logger, trial=trials[index])
+
+                # Check Early-Stopping Step
+                if early_stoppers[index](score=optim_score, model=batched_model.get_model_view(position)):
+                    early_stopping_reporting(logger=logger, trial=trials[index])
+                    optimizer.deactivate(position)
+                    continue
+
+                # Pruning Step
+                pso_value = pruning_step(val_metrics=val_metrics_processed,
+                                         intermediate_score=optim_score, epoch_index=epoch_index,
+                                         logger=logger, trial=trials[index])
+                if pso_value is not None:
+                    scores[index] = pso_value
+                    optimizer.deactivate(position)
+
+    for group, batched_model in zip(groups, batched_models):
+
+        # Complete Training
+        for position, index in enumerate(group):
+            if scores[index] is None:
+                completing_reporting(logger=logger, trial=trials[index])
+                batched_model.load_model_state_dict(position, early_stoppers[index].get_best_model_params())
+
+        # Evaluate Models (TestSet) - Evaluation Metrics
+        _, test_metrics = batched_eval_step(test_loader, batched_model, loss_fn)
+
+        for position, index in enumerate(group):
+            if scores[index] is not None:
+                continue
+            test_metrics_processed = [i.item() for i in test_metrics[position]]
+
+            # Evaluate Model - Optimization Score
+            scores[index] = regularizer(score=test_metrics_processed[get_metric_to_follow(models[index])],
+                                        network_architecture=batched_model.get_network_architecture(position))
+
+            # Print Final Evaluation
+            final_evaluation_reporting(test_metrics=test_metrics_processed,
+                                       final_score=scores[index],
+                                       logger=logger, trial=trials[index])
+
+    return scores
+
+
 def intermediate_reporting(val_loss, val_metrics, intermediate_score, epoch_index, logger, trial):
     trial.set_user_attr(key='epochs', value=epoch_index+1)
 
@@ -88,8 +176,8 @@ def pruning_step(val_metrics, intermediate_score, epoch_index, logger, trial):
     if (intermediate_score < 0) or (trial.should_prune()):
         trial.set_user_attr(key='accuracy', value=round(val_metrics[0], 4))
         trial.set_user_attr(key='precision', value=round(val_metrics[1], 4))
-        trial.set_user_attr(key='recall', value=round(val_metrics[3], 4))
-        trial.set_user_attr(key='f1', value=round(val_metrics[4], 4))
+        trial.set_user_attr(key='recall', value=round(val_metrics[2], 4))
+        trial.set_user_attr(key='f1', value=round(val_metrics[3], 4))
 
         logger.log(f"Trial Gen n°{trial.generation} - Particle n°{trial.particle_id} Pruned!\n\n")
 
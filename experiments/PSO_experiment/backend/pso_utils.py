@@ -1,6 +1,12 @@
-from experiments.PSO_experiment.backend.PSO import PSOTrial
+from typing import TYPE_CHECKING
+
+import numpy as np
+
 from utils.optimization.regularizer import MODEL_ARCHITECTURES_WEEDMAPPING
 
+if TYPE_CHECKING:   # PSO imports this module for the particle encoding
+    from experiments.PSO_experiment.backend.PSO import PSOTrial
+
 
 ACTIVATION_FN_BOUNDS = {
     'sigmoid': [0, 1],
@@ -23,10 +29,48 @@ BACKBONE_BOUNDS = {
 }
 
 
-def build_encoded_dict(trial: PSOTrial, hyperparameters_bounds: dict):
+def build_encoded_dict(trial: 'PSOTrial', hyperparameters_bounds: dict):
     return {key: trial.hyperparameters[key] for key in hyperparameters_bounds.keys()}
 
 
 def decode_hyperparameter(hyperparameter_encodings: dict):
     max_key = max(hyperparameter_encodings, key=hyperparameter_encodings.get)
     return max_key
+
+
+# Optional third element of a [low, high] bound, selecting how the dimension is laid out in the particle space
+LOG_SCALE = 'log'            # Searched uniformly in log space
+INT_SCALE = 'int'            # One equal-width cell per admissible value, optional fourth element is the step
+INT_LOG_SCALE = 'int_log'    # Value k owns [log k, log(k+1)): a log-uniform search, cells narrow as k grows
+
+
+def encode_bound(low, high, scale=None, step=1):
+    if scale is None:
+        return [low, high]
+    if scale == LOG_SCALE:
+        return [np.log(low), np.log(high)]
+    if scale == INT_SCALE:
+        return [0, ((high - low) // step) + 1]
+    if scale == INT_LOG_SCALE:
+        return [np.log(low), np.log(high + 1)]
+    raise ValueError(f"Scale {scale} not supported.")
+
+
+def decode_value(x, low, high, scale=None, step=1):
+    if scale is None:
+        return x
+    if scale == LOG_SCALE:
+        return float(np.clip(np.exp(x), low, high))
+    if scale == INT_SCALE:
+        return int(low + step * min(int(x), (high - low) // step))
+    if scale == INT_LOG_SCALE:
+        return int(np.clip(np.floor(np.exp(x)), low, high))
+    raise ValueError(f"Scale {scale} not supported.")
+
+
+def encode_bounds(hyperparameters_bounds: dict):
+    return np.array([encode_bound(*bound) for bound in hyperparameters_bounds.values()], dtype=float)
+
+
+def decode_position(position, hyperparameters_bounds: dict):
+    return {key: decode_value(x, *bound) for x, (key, bound) in zip(position, hyperparameters_bounds.items())}
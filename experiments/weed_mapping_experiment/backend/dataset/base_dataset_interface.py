@@ -65,9 +65,9 @@ class DatasetInterface:
         cutmix_params = get_param(self.dataset_params, 'cutmix_params')
 
         # WRAPPING collate_fn
-        train_collate_fn = get_param(self.trainset, 'collate_fn')
-        val_collate_fn = get_param(self.valset, 'collate_fn')
-        test_collate_fn = get_param(self.testset, 'collate_fn')
+        train_collate_fn = getattr(self.trainset, 'collate_fn', None)
+        val_collate_fn = getattr(self.valset, 'collate_fn', None)
+        test_collate_fn = getattr(self.testset, 'collate_fn', None)
 
         if cutmix and train_collate_fn is not None:
             raise Exception("cutmix and collate function cannot be used together")
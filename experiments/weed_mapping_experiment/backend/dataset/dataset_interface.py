@@ -15,7 +15,10 @@ from PIL import Image
 from experiments.weed_mapping_experiment.backend.model.base_model import get_param
 from experiments.weed_mapping_experiment.backend.dataset.base_dataset_interface import DatasetInterface
 from experiments.weed_mapping_experiment.backend.dataset.rededge_stats import STATS as REDEDGE_STATS
-from experiments.weed_mapping_experiment.backend.dataset.transforms import PairRandomCrop, PairRandomFlip, PairFourCrop, squeeze0, ToLong, FixValue, SegOneHot
+from experiments.weed_mapping_experiment.backend.dataset.transforms import PairRandomCrop, PairRandomFlip, PairFourCrop, PairBatchAugmentation, FourCropStack, four_crop_collate, squeeze0, ToLong, FixValue, SegOneHot
+from experiments.weed_mapping_experiment.backend.dataset.tile_cache import TileCache, build_tile_cache
+from experiments.weed_mapping_experiment.backend.dataset.loader_pool import DataLoaderPool
+from experiments.weed_mapping_experiment.backend.dataset.manifest import WeedMapManifest
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +42,7 @@ class WeedMapDatasetInterface(DatasetInterface):
                     f"Warning! Dataset name should match the dataset, found: {name}, {dataset_params['root']}")
         self.dataset_name = name
         self.size = (len(channels),) + self.size[1:]
+        self.loader_pool = DataLoaderPool()
 
         mean, std = self.get_mean_std(dataset_params['train_folders'], channels, name)
 
@@ -56,52 +60,82 @@ class WeedMapDatasetInterface(DatasetInterface):
             transforms.Normalize(self.lib_dataset_params['mean'], self.lib_dataset_params['std']),
         ]
 
-        test_target_transform = [
-            transforms.PILToTensor(),
-            squeeze0,
-            ToLong(),
-            FixValue(source=10000, target=1)
-        ]
-
-        target_transform = [
-            transforms.PILToTensor(),
-            squeeze0,
-            ToLong(),
-            FixValue(source=10000, target=1)
-        ]
+        # Cached ground truths are already decoded and fixed
+        tile_cache = get_param(self.dataset_params, 'tile_cache')
+        if tile_cache is not None:
+            test_target_transform = [ToLong()]
+            target_transform = [ToLong()]
+        else:
+            test_target_transform = [
+                transforms.PILToTensor(),
+                squeeze0,
+                ToLong(),
+                FixValue(source=10000, target=1)
+            ]
+
+            target_transform = [
+                transforms.PILToTensor(),
+                squeeze0,
+                ToLong(),
+                FixValue(source=10000, target=1)
+            ]
         period = 1
 
+        # Batch augmentation: train/val crops, flips and resizes run on the collated batch, on the training device
+        # given as the 'device' dataset param (where the batch was collated if missing)
+        batch_augmentation = get_param(self.dataset_params, 'batch_augmentation', default_val=False)
         crop_size = get_param(self.dataset_params, 'crop_size', default_val='same')
+        size = get_param(self.dataset_params, 'size', default_val='same')
+        self.batch_augmentation = None
+        if batch_augmentation:
+            self.batch_augmentation = PairBatchAugmentation(crop_size=crop_size if crop_size != 'same' else None,
+                                                            hor_flip=dataset_params['hor_flip'],
+                                                            ver_flip=dataset_params['ver_flip'],
+                                                            size=size if size != 'same' else None,
+                                                            device=get_param(self.dataset_params, 'device'))
+
+        # Opt-in stacked test crops: every test tile is decoded once and yields its four crops together
+        stack_test_crops = get_param(self.dataset_params, 'stack_test_crops', default_val=False)
+        self.test_crops_per_sample = 1
         if crop_size != 'same':
-            crop = PairRandomCrop(crop_size)
-            test_crop = PairFourCrop(crop_size, periodicity=period)
+            if stack_test_crops:
+                test_crop = FourCropStack(crop_size)
+                self.test_crops_per_sample = 4
+            else:
+                test_crop = PairFourCrop(crop_size, periodicity=period)
+                period *= 4
 
-            input_transform.append(crop)
-            target_transform.append(crop)
             test_transform.append(test_crop)
             test_target_transform.append(test_crop)
-            period *= 4
 
-        if dataset_params['hor_flip']:
+            if not batch_augmentation:
+                crop = PairRandomCrop(crop_size)
+
+                input_transform.append(crop)
+                target_transform.append(crop)
+
+        if dataset_params['hor_flip'] and not batch_augmentation:
             flip_hor = PairRandomFlip(orientation="horizontal")
 
             input_transform.append(flip_hor)
             target_transform.append(flip_hor)
 
-        if dataset_params['ver_flip']:
+        if dataset_params['ver_flip'] and not batch_augmentation:
             flip_ver = PairRandomFlip(orientation="vertical")
 
             input_transform.append(flip_ver)
             target_transform.append(flip_ver)
 
-        if get_param(self.dataset_params, 'size', default_val='same') != 'same':
-            resize = transforms.Resize(size=get_param(self.dataset_params, 'size', default_val='same'))
+        if size != 'same':
+            resize = transforms.Resize(size=size)
 
-            input_transform.append(resize)
-            target_transform.append(resize)
             test_transform.append(resize)
             test_target_transform.append(resize)
 
+            if not batch_augmentation:
+                input_transform.append(resize)
+                target_transform.append(resize)
+
         target_transform = transforms.Compose(target_transform)
         input_transform = transforms.Compose(input_transform)
         test_transform = transforms.Compose(test_transform)
@@ -111,24 +145,37 @@ class WeedMapDatasetInterface(DatasetInterface):
         self.train_folders = dataset_params['train_folders']
         self.test_folders = dataset_params['test_folders']
 
-        train_index = WeedMapDataset.build_index(self.dataset_params['root'], self.train_folders, channels)
-        test_index = WeedMapDataset.build_index(self.dataset_params['root'], self.test_folders, channels)
-        train_index, val_index = train_test_split(train_index, test_size=0.2)
+        # With a manifest the directory listing and the seeded validation split are read from disk
+        manifest = get_param(self.dataset_params, 'manifest')
+        split_seed = get_param(self.dataset_params, 'split_seed', default_val=0 if manifest is not None else None)
+        self.manifest = WeedMapManifest(self.dataset_params['root'], manifest) if manifest is not None else None
+        if self.manifest is not None:
+            train_index, val_index = self.manifest.get_split(self.train_folders, channels, test_size=0.2, seed=split_seed)
+            test_index = self.manifest.build_index(self.test_folders, channels)
+        else:
+            train_index = WeedMapDataset.build_index(self.dataset_params['root'], self.train_folders, channels)
+            test_index = WeedMapDataset.build_index(self.dataset_params['root'], self.test_folders, channels)
+            train_index, val_index = train_test_split(train_index, test_size=0.2, random_state=split_seed)
+
+        if tile_cache is not None:
+            build_tile_cache(self.dataset_params['root'], self.train_folders + self.test_folders, channels, tile_cache)
 
         self.trainset = WeedMapDataset(root=self.dataset_params['root'], channels=channels,
                                        batch_size=self.dataset_params['batch_size'], index=train_index,
                                        transform=input_transform, target_transform=target_transform,
-                                       return_path=dataset_params['return_path'])
+                                       return_path=dataset_params['return_path'], tile_cache=tile_cache)
 
         self.valset = WeedMapDataset(root=self.dataset_params['root'], channels=channels,
                                      batch_size=self.dataset_params['val_batch_size'], index=val_index,
                                      transform=input_transform, target_transform=target_transform,
-                                     return_path=dataset_params['return_path'])
+                                     return_path=dataset_params['return_path'], tile_cache=tile_cache)
 
         self.testset = WeedMapDataset(root=self.dataset_params['root'], channels=channels,
                                       batch_size=self.dataset_params['test_batch_size'], index=test_index,
                                       transform=test_transform, target_transform=test_target_transform,
-                                      return_path=dataset_params['return_path'], period=period)
+                                      return_path=dataset_params['return_path'], period=period, tile_cache=tile_cache)
+        if self.test_crops_per_sample > 1:
+            self.testset.collate_fn = four_crop_collate
 
     @classmethod
     def get_mean_std(cls, train_folders, channels, dataset_name):
@@ -174,6 +221,8 @@ class WeedMapDatasetInterface(DatasetInterface):
             val_batch_size = self.dataset_params['val_batch_size'] * self.batch_size_factor
         if test_batch_size is None:
             test_batch_size = self.dataset_params['test_batch_size'] * self.batch_size_factor
+        # The test batch size counts crops, stacked test samples hold several of them
+        test_batch_size = max(1, test_batch_size // self.test_crops_per_sample)
 
         train_loader_drop_last = get_param(self.dataset_params, 'train_loader_drop_last', default_val=False)
 
@@ -181,42 +230,38 @@ class WeedMapDatasetInterface(DatasetInterface):
         cutmix_params = get_param(self.dataset_params, 'cutmix_params')
 
         # WRAPPING collate_fn
-        train_collate_fn = get_param(self.trainset, 'collate_fn')
-        val_collate_fn = get_param(self.valset, 'collate_fn')
-        test_collate_fn = get_param(self.testset, 'collate_fn')
+        train_collate_fn = getattr(self.trainset, 'collate_fn', None)
+        val_collate_fn = getattr(self.valset, 'collate_fn', None)
+        test_collate_fn = getattr(self.testset, 'collate_fn', None)
 
         if cutmix and train_collate_fn is not None:
             raise Exception("cutmix and collate function cannot be used together")
 
-        pw = num_workers > 0
-        self.train_loader = torch.utils.data.DataLoader(self.trainset,
+        # Loaders come from the pool: later calls (e.g. one per trial) reuse the running worker processes
+        self.train_loader = self.loader_pool.get_loader('train', self.trainset,
                                                         batch_size=train_batch_size,
                                                         shuffle=train_shuffle,
-                                                        num_workers=num_workers,
-                                                        pin_memory=True,
+                                                        drop_last=train_loader_drop_last,
                                                         sampler=train_sampler,
                                                         collate_fn=train_collate_fn,
-                                                        drop_last=train_loader_drop_last,
-                                                        persistent_workers=pw)
+                                                        num_workers=num_workers)
 
-        self.val_loader = torch.utils.data.DataLoader(self.valset,
+        self.val_loader = self.loader_pool.get_loader('val', self.valset,
                                                       batch_size=val_batch_size,
-                                                      shuffle=False,
-                                                      num_workers=num_workers,
-                                                      pin_memory=True,
                                                       sampler=val_sampler,
                                                       collate_fn=val_collate_fn,
-                                                      persistent_workers=pw)
+                                                      num_workers=num_workers)
 
         if self.testset is not None:
-            self.test_loader = torch.utils.data.DataLoader(self.testset,
+            self.test_loader = self.loader_pool.get_loader('test', self.testset,
                                                            batch_size=test_batch_size,
-                                                           shuffle=False,
-                                                           num_workers=num_workers,
-                                                           pin_memory=True,
                                                            sampler=test_sampler,
                                                            collate_fn=test_collate_fn,
-                                                           persistent_workers=pw)
+                                                           num_workers=num_workers)
+
+        if self.batch_augmentation is not None:
+            self.train_loader = BatchAugmentedLoader(self.train_loader, self.batch_augmentation)
+            self.val_loader = BatchAugmentedLoader(self.val_loader, self.batch_augmentation)
 
         self.classes = self.trainset.classes
 
@@ -225,7 +270,10 @@ class WeedMapDatasetInterface(DatasetInterface):
         folders = folders if folders is not None else self.test_folders
         root = root if root is not None else self.dataset_params['root']
 
-        index = WeedMapDataset.build_index(root, folders, self.dataset_params['channels'])
+        if self.manifest is not None and root == self.dataset_params['root']:
+            index = self.manifest.build_index(folders, self.dataset_params['channels'])
+        else:
+            index = WeedMapDataset.build_index(root, folders, self.dataset_params['channels'])
         input_transform = [
             transforms.Normalize(self.lib_dataset_params['mean'], self.lib_dataset_params['std']),
         ]
@@ -258,6 +306,24 @@ class WeedMapDatasetInterface(DatasetInterface):
         return loader
 
 
+class BatchAugmentedLoader:
+    # Augments every collated batch on the augmentation's device, the workers only read and decode
+    def __init__(self, loader, augmentation: PairBatchAugmentation):
+        self.loader = loader
+        self.augmentation = augmentation
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        for img, gt, *extra in self.loader:
+            yield self.augmentation(img, gt) + tuple(extra)
+
+    def __len__(self):
+        return len(self.loader)
+
+
 class WeedMapDataset(VisionDataset):
     CLASS_LABELS = {0: "background", 1: "crop", 2: 'weed'}
     classes = ['background', 'crop', 'weed']
@@ -272,6 +338,7 @@ class WeedMapDataset(VisionDataset):
                  return_mask: bool = False,
                  return_path: bool = False,
                  period: int = None,
+                 tile_cache: str = None,
                  ):
 
         self.batch_size = batch_size
@@ -283,6 +350,11 @@ class WeedMapDataset(VisionDataset):
         else:
             self.get_img = self.get_channels
 
+        # Pre-packed memory-mapped tiles (see build_tile_cache) replace the per-sample PNG decoding
+        self.tile_cache = TileCache(tile_cache, channels) if tile_cache is not None else None
+        if self.tile_cache is not None:
+            self.get_img = self.tile_cache.get_image
+
         if index:
             self.index = index
         else:
@@ -340,15 +412,20 @@ class WeedMapDataset(VisionDataset):
         ]
         )
 
-    def __getitem__(self, index: int) -> Any:
-
-        folder, file = self.index[index]
-        img = self.get_img(folder, file)
-        gt = Image.open(
+    def get_groundtruth(self, folder, file) -> Any:
+        if self.tile_cache is not None:
+            return self.tile_cache.get_groundtruth(folder, file)
+        return Image.open(
             os.path.join(self.path, folder, 'groundtruth',
                          folder + '_' + file.split('.')[0] + '_GroundTruth_iMap.png'
                          )
         )
+
+    def __getitem__(self, index: int) -> Any:
+
+        folder, file = self.index[index]
+        img = self.get_img(folder, file)
+        gt = self.get_groundtruth(folder, file)
         img = self.transform(img)
         gt = self.target_transform(gt)
 
@@ -0,0 +1,97 @@
+import logging
+import threading
+
+import torch
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler, Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSamplerSlot(Sampler):
+    # Fixed batch_sampler of a pooled loader: a resize installs a new BatchSampler, an epoch already started keeps its own
+    def __init__(self, batch_sampler: BatchSampler):
+        self.batch_sampler = batch_sampler
+
+    def __iter__(self):
+        return iter(self.batch_sampler)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class DataLoaderPool:
+    # Registry of persistent-worker DataLoaders keyed on (split, batch size, consumer thread), kept alive across trials.
+    # Every thread (e.g. each Optuna n_jobs worker) gets its own loaders, so concurrent trials never share a worker
+    # iterator; the trials a thread runs one after the other reuse them, resizing the batches without respawning workers.
+    # Worker pools only persist within one process: under the joblib/process-pool PSO paths every task unpickles a fresh
+    # interface (and an empty pool), so nothing is reused there.
+    def __init__(self, pin_memory=True):
+        self.pin_memory = pin_memory
+        self.loaders = {}
+        self._lock = threading.Lock()
+
+    def get_loader(self, split, dataset, batch_size, shuffle=False, drop_last=False, sampler=None, collate_fn=None,
+                   num_workers=8):
+        consumer = threading.get_ident()
+        key = (split, batch_size, consumer)
+
+        with self._lock:
+            loader = self.loaders.get(key)
+            if loader is not None and self._matches(loader, dataset, sampler, num_workers, collate_fn):
+                return loader
+
+            # Resize this consumer's existing pool for the split instead of spawning a new one
+            for other_key, other_loader in list(self.loaders.items()):
+                if other_key[0] == split and other_key[2] == consumer and \
+                        self._matches(other_loader, dataset, sampler, num_workers, collate_fn):
+                    del self.loaders[other_key]
+                    slot = other_loader.batch_sampler
+                    slot.batch_sampler = BatchSampler(slot.batch_sampler.sampler, batch_size=batch_size, drop_last=drop_last)
+                    self.loaders[key] = other_loader
+                    return other_loader
+
+            for other_key in [k for k in self.loaders if k[0] == split and k[2] == consumer]:
+                self._shutdown(self.loaders.pop(other_key))
+
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            loader = torch.utils.data.DataLoader(dataset,
+                                                 batch_sampler=BatchSamplerSlot(BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)),
+                                                 num_workers=num_workers,
+                                                 pin_memory=self.pin_memory,
+                                                 collate_fn=collate_fn,
+                                                 persistent_workers=num_workers > 0)
+            logger.debug(f"Spawned loader for split {split} (batch size {batch_size}, {num_workers} workers)")
+            self.loaders[key] = loader
+            return loader
+
+    def shutdown(self):
+        with self._lock:
+            for loader in self.loaders.values():
+                self._shutdown(loader)
+            self.loaders = {}
+
+    @staticmethod
+    def _matches(loader, dataset, sampler, num_workers, collate_fn):
+        return (loader.dataset is dataset) and (loader.num_workers == num_workers) and \
+            (sampler is None or type(loader.batch_sampler.batch_sampler.sampler) is type(sampler)) and \
+            (collate_fn is None or loader.collate_fn is collate_fn)
+
+    @staticmethod
+    def _shutdown(loader):
+        iterator = getattr(loader, '_iterator', None)
+        if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+            iterator._shutdown_workers()
+        loader._iterator = None
+
+    def __getstate__(self):
+        # Live worker pools cannot leave the process: a copy starts empty
+        return {'pin_memory': self.pin_memory}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __del__(self):
+        if hasattr(self, 'loaders'):
+            self.shutdown()
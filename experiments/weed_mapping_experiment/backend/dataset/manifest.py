@@ -0,0 +1,89 @@
+import json
+import os
+from typing import Iterable, Union
+
+from sklearn.model_selection import train_test_split
+
+
+class WeedMapManifest:
+    # Persistent index of the dataset tree: for every macro folder the tiles, their available channels and
+    # their sizes/mtimes, plus the seeded validation splits. A folder is rescanned only when the mtime of
+    # one of its directories changes, so loading costs a few stat calls instead of listing every folder.
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path if path is not None else os.path.join(root, 'manifest.json')
+
+        self.folders = {}
+        self.splits = {}
+        self._dirty = False
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get('root') == os.path.abspath(root):
+                self.folders = manifest['folders']
+                self.splits = manifest['splits']
+
+    def get_folder(self, folder):
+        entry = self.folders.get(folder)
+        if entry is None or entry['dirs'] != self._get_dir_mtimes(folder):
+            entry = self._scan_folder(folder)
+            self.folders[folder] = entry
+            # Splits built on a stale folder are no longer valid
+            self.splits = {key: split for key, split in self.splits.items() if folder not in json.loads(key)['folders']}
+            self._dirty = True
+        return entry
+
+    def build_index(self, macro_folders: Iterable = None, channels: Union[Iterable, str] = 'CIR') -> list:
+        if macro_folders is None:
+            macro_folders = sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d, 'tile')))
+        required = [channels] if isinstance(channels, str) else list(channels)
+
+        index = []
+        for folder in macro_folders:
+            files = self.get_folder(folder)['files']
+            index += [(folder, file) for file in sorted(files) if all(c in files[file]['channels'] for c in required)]
+        self.save()
+        return index
+
+    def get_split(self, macro_folders: Iterable, channels: Union[Iterable, str] = 'CIR', test_size=0.2, seed=0):
+        # Same split as train_test_split(index, test_size), but seeded and stored with the manifest
+        index = self.build_index(macro_folders, channels)
+        key = json.dumps({'folders': sorted(macro_folders), 'channels': channels, 'test_size': test_size, 'seed': seed},
+                         sort_keys=True)
+        if key not in self.splits:
+            train_index, val_index = train_test_split(index, test_size=test_size, random_state=seed)
+            self.splits[key] = {'train': train_index, 'val': val_index}
+            self._dirty = True
+            self.save()
+        split = self.splits[key]
+        return [tuple(x) for x in split['train']], [tuple(x) for x in split['val']]
+
+    def save(self):
+        if not self._dirty:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'root': os.path.abspath(self.root), 'folders': self.folders, 'splits': self.splits}, f)
+        os.replace(self.path + '.tmp', self.path)
+        self._dirty = False
+
+    def _get_dir_mtimes(self, folder):
+        dirs = {}
+        tile_dir = os.path.join(self.root, folder, 'tile')
+        for channel in sorted(os.listdir(tile_dir)):
+            dirs[f'tile/{channel}'] = os.stat(os.path.join(tile_dir, channel)).st_mtime_ns
+        gt_dir = os.path.join(self.root, folder, 'groundtruth')
+        if os.path.isdir(gt_dir):
+            dirs['groundtruth'] = os.stat(gt_dir).st_mtime_ns
+        return dirs
+
+    def _scan_folder(self, folder):
+        files = {}
+        tile_dir = os.path.join(self.root, folder, 'tile')
+        for channel in sorted(os.listdir(tile_dir)):
+            with os.scandir(os.path.join(tile_dir, channel)) as entries:
+                for entry in entries:
+                    stat = entry.stat()
+                    record = files.setdefault(entry.name, {'channels': {}})
+                    record['channels'][channel] = [stat.st_size, stat.st_mtime_ns]
+        return {'dirs': self._get_dir_mtimes(folder), 'files': files}
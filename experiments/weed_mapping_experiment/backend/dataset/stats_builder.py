@@ -0,0 +1,113 @@
+import argparse
+import ast
+import json
+import os
+from typing import Iterable
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from experiments.weed_mapping_experiment.backend.dataset.tile_cache import read_tile
+
+
+class ChannelMoments:
+    # Per-channel count, mean and sum of squared deviations (M2), merged with Chan's parallel formula
+    def __init__(self, num_channels):
+        self.count = 0
+        self.mean = np.zeros(num_channels, dtype=np.float64)
+        self.m2 = np.zeros(num_channels, dtype=np.float64)
+
+    def update(self, pixels):
+        # pixels: (C, N) values of one tile
+        pixels = pixels.astype(np.float64)
+        tile_moments = ChannelMoments(len(self.mean))
+        tile_moments.count = pixels.shape[1]
+        tile_moments.mean = pixels.mean(axis=1)
+        tile_moments.m2 = ((pixels - tile_moments.mean[:, None]) ** 2).sum(axis=1)
+        self.merge(tile_moments)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def to_stats(self, channels):
+        # Same layout as rededge_stats: population std, plus the sums get_mean_std combines across folders
+        stats = {}
+        for i, channel in enumerate(channels):
+            variance = self.m2[i] / self.count
+            stats[channel] = {
+                'mean': float(self.mean[i]),
+                'std': float(np.sqrt(variance)),
+                'sum': float(self.mean[i] * self.count),
+                'sum_sq': float(self.m2[i] + self.count * self.mean[i] ** 2)
+            }
+        stats['count'] = int(self.count)
+        return stats
+
+
+def tiles_moments(root, folder, files, channels):
+    moments = ChannelMoments(len(channels))
+    for file in files:
+        tile = read_tile(root, folder, file, channels)
+        # Same scaling as to_tensor
+        tile = tile / 255 if tile.dtype == np.uint8 else tile
+        moments.update(tile.reshape(len(channels), -1))
+    return moments
+
+
+def build_stats(root, folders: Iterable, channels: Iterable, n_jobs=-1, chunk_size=32):
+    # Streams the tiles of every folder in chunks over worker processes, only the moments travel back
+    channels = list(channels)
+    tasks = []
+    for folder in folders:
+        files = sorted(os.listdir(os.path.join(root, folder, 'tile', channels[0])))
+        tasks += [(folder, files[i:i + chunk_size]) for i in range(0, len(files), chunk_size)]
+
+    results = Parallel(n_jobs=n_jobs)(delayed(tiles_moments)(root, folder, files, channels) for folder, files in tasks)
+
+    folder_moments = {folder: ChannelMoments(len(channels)) for folder in folders}
+    for (folder, _), moments in zip(tasks, results):
+        folder_moments[folder].merge(moments)
+    return {folder: moments.to_stats(channels) for folder, moments in folder_moments.items()}
+
+
+def load_stats(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return ast.literal_eval(f.read().split('=', 1)[1])
+
+
+def write_stats(stats, path, update=True):
+    # Existing folders/channels not rebuilt are kept, so a new field or channel can be added alone
+    if update:
+        merged = load_stats(path)
+        for folder, folder_stats in stats.items():
+            if folder in merged and merged[folder]['count'] != folder_stats['count']:
+                raise ValueError(f"Pixel count mismatch for folder {folder}: {merged[folder]['count']} != {folder_stats['count']}")
+            merged.setdefault(folder, {}).update(folder_stats)
+            merged[folder]['count'] = merged[folder].pop('count')
+        stats = merged
+    with open(path + '.tmp', 'w') as f:
+        f.write('STATS = ' + json.dumps(stats, indent=4))
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the per-channel mean/std statistics of WeedMap folders.')
+    parser.add_argument('root')
+    parser.add_argument('--folders', nargs='+', required=True)
+    parser.add_argument('--channels', nargs='+', default=['R', 'G', 'B', 'NDVI', 'NIR', 'RE'])
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(__file__), 'rededge_stats.py'))
+    parser.add_argument('--n-jobs', type=int, default=-1)
+    parser.add_argument('--chunk-size', type=int, default=32)
+    args = parser.parse_args()
+
+    write_stats(build_stats(args.root, args.folders, args.channels, n_jobs=args.n_jobs, chunk_size=args.chunk_size),
+                args.output)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+from typing import Iterable, Union
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+CACHE_FORMAT = 2     # Bumped whenever the packed layout or the pixel conversion changes
+
+# Pixel type of the tensor to_tensor returns for each decoded dtype (I;16 is read as int16, without any scaling)
+TENSOR_DTYPES = {np.dtype(np.uint8): np.uint8, np.dtype(np.uint16): np.int16, np.dtype(np.int16): np.int16,
+                 np.dtype(np.int32): np.int32, np.dtype(np.float32): np.float32}
+
+
+def get_channels_key(channels: Union[str, Iterable]) -> str:
+    return channels if isinstance(channels, str) else '-'.join(channels)
+
+
+def get_cache_key(channels: Union[str, Iterable]) -> str:
+    # Channels plus a hash of every parameter the packed arrays depend on. A single channel name and the one-element
+    # list WeedMapDataset turns into it ('R' and ['R']) read the same folder, so they share the key
+    channels = [channels] if isinstance(channels, str) else list(channels)
+    params = json.dumps({'channels': channels, 'format': CACHE_FORMAT})
+    return f'{get_channels_key(channels)}_{hashlib.sha1(params.encode()).hexdigest()[:8]}'
+
+
+def get_shard_paths(cache_folder, folder, channels):
+    shard_folder = os.path.join(cache_folder, folder)
+    key = get_cache_key(channels)
+    return (os.path.join(shard_folder, f'images_{key}.npy'),
+            os.path.join(shard_folder, f'groundtruth_{key}.npy'),
+            os.path.join(shard_folder, f'files_{key}.json'))
+
+
+def get_sources_signature(root, folder, files, channels):
+    # Size and mtime of every source image: any edited, added or removed tile invalidates the shard
+    channels = [channels] if isinstance(channels, str) else list(channels)
+    sha = hashlib.sha1()
+    for file in files:
+        paths = [os.path.join(root, folder, 'tile', c, file) for c in channels] + [get_groundtruth_path(root, folder, file)]
+        for path in paths:
+            stat = os.stat(path)
+            sha.update(f'{file}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return sha.hexdigest()
+
+
+def get_groundtruth_path(root, folder, file):
+    return os.path.join(root, folder, 'groundtruth', folder + '_' + file.split('.')[0] + '_GroundTruth_iMap.png')
+
+
+def read_tile(root, folder, file, channels):
+    # Raw (C, H, W) pixels, before the to_tensor scaling
+    if isinstance(channels, str):
+        img = np.asarray(Image.open(os.path.join(root, folder, 'tile', channels, file)))
+        return img[None] if img.ndim == 2 else img.transpose(2, 0, 1)
+    return np.stack([np.asarray(Image.open(os.path.join(root, folder, 'tile', c, file))) for c in channels])
+
+
+def read_groundtruth(root, folder, file):
+    gt = np.asarray(Image.open(get_groundtruth_path(root, folder, file))).astype(np.int64)
+    gt[gt == 10000] = 1     # Same fix as FixValue(source=10000, target=1)
+    return gt.astype(np.uint8)
+
+
+def build_tile_cache(root, folders: Iterable, channels: Union[str, Iterable], cache_folder):
+    # One shard per macro folder: all tiles of the folder packed in a single (N, C, H, W) array, plus the ground truths.
+    # A shard is rebuilt when its sources changed since it was packed
+    for folder in folders:
+        images_path, gt_path, files_path = get_shard_paths(cache_folder, folder, channels)
+
+        counter_channel = channels if isinstance(channels, str) else channels[0]
+        files = sorted(os.listdir(os.path.join(root, folder, 'tile', counter_channel)))
+        signature = get_sources_signature(root, folder, files, channels)
+
+        if os.path.exists(images_path) and os.path.exists(gt_path) and os.path.exists(files_path):
+            with open(files_path) as f:
+                if json.load(f).get('signature') == signature:
+                    continue
+        os.makedirs(os.path.dirname(images_path), exist_ok=True)
+
+        first_img = read_tile(root, folder, files[0], channels)
+        dtype = TENSOR_DTYPES.get(first_img.dtype, np.float32)
+        images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=dtype, shape=(len(files), *first_img.shape))
+        gts = np.lib.format.open_memmap(gt_path + '.tmp', mode='w+', dtype=np.uint8, shape=(len(files), *first_img.shape[1:]))
+        for i, file in enumerate(files):
+            images[i] = read_tile(root, folder, file, channels).astype(dtype)    # Same wrap-around cast as to_tensor
+            gts[i] = read_groundtruth(root, folder, file)
+        images.flush()
+        gts.flush()
+        del images, gts
+
+        os.replace(images_path + '.tmp', images_path)
+        os.replace(gt_path + '.tmp', gt_path)
+        with open(files_path + '.tmp', 'w') as f:
+            json.dump({'files': files, 'signature': signature}, f)
+        os.replace(files_path + '.tmp', files_path)
+
+
+class TileCache:
+    def __init__(self, cache_folder, channels: Union[str, Iterable]):
+        self.cache_folder = cache_folder
+        self.channels = channels
+
+        self._shards = {}
+
+    def _attach(self, folder):
+        # Copy-on-write mapping: every worker reads the same page-cache pages, nothing is decoded or pickled
+        images_path, gt_path, files_path = get_shard_paths(self.cache_folder, folder, self.channels)
+        with open(files_path) as f:
+            rows = {file: row for row, file in enumerate(json.load(f)['files'])}
+        self._shards[folder] = np.load(images_path, mmap_mode='c'), np.load(gt_path, mmap_mode='c'), rows
+
+    def get_image(self, folder, file):
+        if folder not in self._shards:
+            self._attach(folder)
+        images, _, rows = self._shards[folder]
+        img = torch.from_numpy(images[rows[file]])
+        # Same scaling as to_tensor: only 8-bit pixels are divided, the other types keep their raw values
+        return img.float().div(255) if img.dtype == torch.uint8 else img.float()
+
+    def get_groundtruth(self, folder, file):
+        if folder not in self._shards:
+            self._attach(folder)
+        _, gts, rows = self._shards[folder]
+        return torch.from_numpy(gts[rows[file]])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
@@ -6,6 +6,7 @@ import PIL
 import torch
 from torch import Tensor
 from torch.nn.functional import one_hot
+from torch.utils.data import default_collate
 
 from torchvision.transforms import functional as F, InterpolationMode
 
@@ -92,6 +93,33 @@ class PairFourCrop(PairSystematicTransform):
         return (state + 1) % 4
 
 
+class FourCropStack:
+    # All the PairFourCrop quadrants of one sample, stacked in state order: (4, C, h, w) images or (4, h, w) targets
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, img):
+        w, h = img.size()[-2:]
+        return torch.stack([
+            F.crop(img, 0, 0, *self.size),
+            F.crop(img, 0, h - self.size[1], *self.size),
+            F.crop(img, w - self.size[0], 0, *self.size),
+            F.crop(img, w - self.size[0], h - self.size[1], *self.size)
+        ])
+
+
+def four_crop_collate(batch):
+    # Flattens the stacked crops: a batch of n samples becomes 4n crops, in the same order as the repeated index
+    imgs, gts, *extra = zip(*batch)
+    collated = (torch.cat(imgs), torch.cat(gts))
+    if extra:
+        collated += (default_collate([e for e in extra[0] for _ in range(4)]),)
+    return collated
+
+
 class PairRandomCrop:
     image_crop_position = {}
 
@@ -187,6 +215,59 @@ class PairRandomRotation(torch.nn.Module):
         return f"{self.__class__.__name__}(p={self.degree})"
 
 
+class PairBatchAugmentation:
+    # Random crops and flips applied jointly to a collated batch of images (B, C, H, W) and targets (B, H, W),
+    # with explicit per-sample parameters. The batch is moved to device (the training device) first, if one is given,
+    # otherwise it is augmented where it lives
+    def __init__(self, crop_size=None, hor_flip=False, ver_flip=False, p=0.5, size=None, device=None):
+        if isinstance(crop_size, numbers.Number):
+            self.crop_size = (int(crop_size), int(crop_size))
+        else:
+            self.crop_size = crop_size
+        self.hor_flip = hor_flip
+        self.ver_flip = ver_flip
+        self.p = p
+        self.size = size
+        self.device = device
+
+    def sample_params(self, batch_size, height, width, device=None, generator=None):
+        th, tw = self.crop_size if self.crop_size is not None else (height, width)
+        return {
+            'top': torch.randint(0, height - th + 1, (batch_size,), device=device, generator=generator),
+            'left': torch.randint(0, width - tw + 1, (batch_size,), device=device, generator=generator),
+            'hor_flip': (torch.rand(batch_size, device=device, generator=generator) < self.p) & self.hor_flip,
+            'ver_flip': (torch.rand(batch_size, device=device, generator=generator) < self.p) & self.ver_flip,
+        }
+
+    def apply(self, images, targets, params):
+        batch_size, _, height, width = images.shape
+        th, tw = self.crop_size if self.crop_size is not None else (height, width)
+
+        # Crop and flip become one gather: per-sample row/column indexes, reversed for the flipped samples
+        rows = params['top'][:, None] + torch.arange(th, device=images.device)
+        cols = params['left'][:, None] + torch.arange(tw, device=images.device)
+        rows = torch.where(params['ver_flip'][:, None], rows.flip(1), rows)
+        cols = torch.where(params['hor_flip'][:, None], cols.flip(1), cols)
+
+        batch_index = torch.arange(batch_size, device=images.device)[:, None, None]
+        images = images[batch_index, :, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2).contiguous()
+        targets = targets[batch_index, rows[:, :, None], cols[:, None, :]]
+
+        if self.size is not None:
+            images = F.resize(images, self.size)
+            targets = F.resize(targets, self.size, interpolation=InterpolationMode.NEAREST)
+        return images, targets
+
+    def __call__(self, images, targets, generator=None):
+        if self.device is not None:
+            images, targets = images.to(self.device, non_blocking=True), targets.to(self.device, non_blocking=True)
+        params = self.sample_params(images.size(0), *images.shape[-2:], device=images.device, generator=generator)
+        return self.apply(images, targets, params)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(crop_size={self.crop_size}, hor_flip={self.hor_flip}, ver_flip={self.ver_flip})"
+
+
 class ToLong:
     def __call__(self, x):
         return x.long()
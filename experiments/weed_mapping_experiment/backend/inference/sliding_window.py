@@ -0,0 +1,128 @@
+import os
+from typing import Iterable
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+def pack_orthomosaic(channel_paths: Iterable, output_path):
+    # Packs one image per channel into a single (C, H, W) .npy, decoding a single channel at a time
+    channel_paths = list(channel_paths)
+    Image.MAX_IMAGE_PIXELS = None
+    first = np.asarray(Image.open(channel_paths[0]))
+    orthomosaic = np.lib.format.open_memmap(output_path + '.tmp', mode='w+', dtype=first.dtype,
+                                            shape=(len(channel_paths), *first.shape))
+    orthomosaic[0] = first
+    del first
+    for i, path in enumerate(channel_paths[1:], start=1):
+        orthomosaic[i] = np.asarray(Image.open(path))
+    orthomosaic.flush()
+    del orthomosaic
+    os.replace(output_path + '.tmp', output_path)
+
+
+def load_orthomosaic(path):
+    # Read-only memory map: windows are paged in on access, the whole field is never loaded
+    return np.load(path, mmap_mode='r')
+
+
+def get_blending_window(tile_size, min_weight=1e-3):
+    # Separable Hann window: tile borders, where the context is poorest, weigh least in the overlaps
+    windows = [np.clip(np.hanning(size + 2)[1:-1], min_weight, None) for size in tile_size]
+    return np.outer(*windows).astype(np.float32)
+
+
+def get_positions(length, tile, stride):
+    if length <= tile:
+        return [0]
+    positions = list(range(0, length - tile, stride))
+    return positions + [length - tile]
+
+
+class SlidingWindowInference:
+    def __init__(self, model, mean, std, num_classes=3, tile_size=256, overlap=0.25, batch_size=4, device=None,
+                 nodata=0):
+        if not 0 <= overlap < 1:
+            raise ValueError(f"Overlap must be in [0, 1), found: {overlap}")
+
+        self.model = model
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        self.num_classes = num_classes
+        self.tile_size = (tile_size, tile_size) if isinstance(tile_size, int) else tuple(tile_size)
+        self.stride = tuple(max(1, int(size * (1 - overlap))) for size in self.tile_size)
+        self.batch_size = batch_size
+        self.device = device if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.nodata = nodata    # Pixels with this value in every channel are outside the field (background)
+
+        self.window = get_blending_window(self.tile_size)
+
+    def __call__(self, orthomosaic, output_path):
+        # orthomosaic: (C, H, W) array or memmap. Only a strip of tile_size rows is held in memory, and the
+        # finished rows of the mask are written to the (H, W) uint8 .npy at output_path as soon as no tile covers them
+        _, height, width = orthomosaic.shape
+        th, tw = self.tile_size
+        ys = get_positions(height, th, self.stride[0])
+        xs = get_positions(width, tw, self.stride[1])
+
+        mask = np.lib.format.open_memmap(output_path + '.tmp', mode='w+', dtype=np.uint8, shape=(height, width))
+        logits = np.zeros((self.num_classes, th, max(width, tw)), dtype=np.float32)
+        strip_start = 0
+
+        self.model.to(self.device).eval()
+        for y in ys:
+            # Rows above y receive no more tiles
+            self._write_rows(orthomosaic, mask, logits, strip_start, y)
+            logits = np.roll(logits, strip_start - y, axis=1)
+            logits[:, th - (y - strip_start):] = 0
+            strip_start = y
+
+            for start in range(0, len(xs), self.batch_size):
+                batch_xs = xs[start:start + self.batch_size]
+                tiles = torch.stack([self._read_tile(orthomosaic, y, x) for x in batch_xs])
+                with torch.no_grad():
+                    batch_logits = self.model(tiles.to(self.device)).float().cpu().numpy()
+
+                for x, tile_logits in zip(batch_xs, batch_logits):
+                    logits[:, :, x:x + tw] += tile_logits * self.window
+
+        self._write_rows(orthomosaic, mask, logits, strip_start, height)
+        del mask
+        os.replace(output_path + '.tmp', output_path)
+        return np.load(output_path, mmap_mode='r')
+
+    def _read_tile(self, orthomosaic, y, x):
+        th, tw = self.tile_size
+        window = np.asarray(orthomosaic[:, y:y + th, x:x + tw])
+        tile = torch.from_numpy(window.astype(np.float32))
+        # Same scaling as to_tensor
+        if window.dtype == np.uint8:
+            tile = tile.div_(255)
+        tile = (tile - self.mean) / self.std
+
+        # Fields smaller than a tile are zero-padded
+        if tile.shape[1:] != (th, tw):
+            tile = torch.nn.functional.pad(tile, (0, tw - tile.shape[2], 0, th - tile.shape[1]))
+        return tile
+
+    def _write_rows(self, orthomosaic, mask, logits, strip_start, end):
+        if end <= strip_start:
+            return
+        rows = min(end, mask.shape[0]) - strip_start
+        width = mask.shape[1]
+
+        # The blending weights are the same positive factor for every class, the argmax needs no normalization
+        strip_mask = logits[:, :rows, :width].argmax(axis=0).astype(np.uint8)
+        if self.nodata is not None:
+            strip_mask[(np.asarray(orthomosaic[:, strip_start:strip_start + rows]) == self.nodata).all(axis=0)] = 0
+        mask[strip_start:strip_start + rows] = strip_mask
+        mask.flush()
+
+
+def run_orthomosaic_inference(model, dataset_interface, orthomosaic_path, output_path, **kwargs):
+    # Normalization from the dataset interface the model was trained with
+    mean = dataset_interface.lib_dataset_params['mean']
+    std = dataset_interface.lib_dataset_params['std']
+    inference = SlidingWindowInference(model, mean, std, num_classes=len(dataset_interface.trainset.classes), **kwargs)
+    return inference(load_orthomosaic(orthomosaic_path), output_path)
@@ -1,7 +1,11 @@
 from torch.utils.data import DataLoader
 
+from utils.dataset.tensor_dataset import PreloadedTensorDataset, TensorBatchLoader
+
 
 def init_data_loader(dataset, batch_size=32):
+    if isinstance(dataset, PreloadedTensorDataset):
+        return TensorBatchLoader(dataset, batch_size=batch_size, shuffle=True)
     return DataLoader(dataset, batch_size=batch_size, shuffle=True)
 
 
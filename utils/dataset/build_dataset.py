@@ -1,8 +1,12 @@
+import torch
 from torch.utils.data import random_split
 from torchvision.datasets import MNIST
 from torchvision.transforms import ToTensor
 
 from experiments.weed_mapping_experiment.backend.dataset.dataset_interface import WeedMapDatasetInterface
+from utils.dataset.shared_dataset import share_dataset
+from utils.misc.device import get_device
+from utils.dataset.tensor_dataset import PreloadedTensorDataset
 
 
 def load_MNIST_data(root_folder):
@@ -14,16 +18,40 @@ def load_MNIST_data(root_folder):
     return train_dataset, val_dataset, test_dataset
 
 
-def data_split(dataset, train_split=0.8):
+def load_MNIST_data_shared(root_folder, shared_folder):
+    train_dataset, val_dataset, test_dataset = load_MNIST_data(root_folder)
+
+    return (share_dataset(train_dataset, shared_folder, 'MNIST_train'),
+            share_dataset(val_dataset, shared_folder, 'MNIST_val'),
+            share_dataset(test_dataset, shared_folder, 'MNIST_test'))
+
+
+def load_MNIST_data_preloaded(root_folder, device=None):
+    dataset = MNIST(root=root_folder, download=True, train=True)
+    test_dataset = MNIST(root=root_folder, download=True, train=False)
+
+    # Same (seeded) split as load_MNIST_data, applied to the raw uint8 tensors instead of the PIL pipeline
+    train_subset, val_subset = data_split(dataset=dataset, train_split=0.8)
+    images, targets = dataset.data.unsqueeze(1), dataset.targets
+
+    return (PreloadedTensorDataset(images[train_subset.indices], targets[train_subset.indices], device=device),
+            PreloadedTensorDataset(images[val_subset.indices], targets[val_subset.indices], device=device),
+            PreloadedTensorDataset(test_dataset.data.unsqueeze(1), test_dataset.targets, device=device))
+
+
+def data_split(dataset, train_split=0.8, seed=0):
+    # Seeded, so every call (and every loader below) draws the same split and shared memmaps stay reusable
     train_size = int(train_split * len(dataset))
     val_size = len(dataset) - train_size
-    train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+    train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator=torch.Generator().manual_seed(seed))
 
     return train_dataset, val_dataset
 
 
-def load_weedmap_data():
-    return WeedMapDatasetInterface(dict(
+def load_weedmap_data(tile_cache=False, manifest=False, batch_augmentation=False):
+    # Opt-in: tile_cache packs the tiles into memory-mapped shards and manifest indexes the dataset tree (both write
+    # their files next to the dataset), batch_augmentation crops/flips the collated batches on the training device
+    dataset_params = dict(
         root="../../../../../0_rotations_processed_003_test/RedEdge",
         # root="../../experiments/weed_mapping_experiment/data_weedmap/Weed Map Dataset Processed/RedEdge",
         # root="data_weedmap/Weed Map Dataset Processed/RedEdge",     # For Azure ML
@@ -37,4 +65,12 @@ def load_weedmap_data():
         ver_flip=True,
         return_path=False,
         num_classes=3,
-    ))
+    )
+    if tile_cache:
+        dataset_params['tile_cache'] = dataset_params['root'] + '_cache'
+    if manifest:
+        dataset_params['manifest'] = dataset_params['root'] + '_manifest.json'
+    if batch_augmentation:
+        dataset_params.update(batch_augmentation=True, device=get_device())
+
+    return WeedMapDatasetInterface(dataset_params)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Subset
+
+
+class MemmapTensorDataset(Dataset):
+    def __init__(self, data_path, targets_path):
+        self.data_path = data_path
+        self.targets_path = targets_path
+
+        self._data = None
+        self._targets = None
+
+    def _attach(self):
+        # Copy-on-write mapping: every process reads the same page-cache pages, nothing is pickled
+        self._data = torch.from_numpy(np.load(self.data_path, mmap_mode='c'))
+        self._targets = torch.from_numpy(np.load(self.targets_path, mmap_mode='c'))
+
+    def __getitem__(self, index):
+        if self._data is None:
+            self._attach()
+        return self._data[index], self._targets[index]
+
+    def __len__(self):
+        if self._data is None:
+            self._attach()
+        return len(self._targets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_targets'] = None
+        return state
+
+
+def get_dataset_source(dataset):
+    # Identifies the samples a dataset yields: the wrapped dataset plus, for a Subset, a hash of its indices
+    if isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices, dtype=np.int64)
+        return f'{get_dataset_source(dataset.dataset)}[{hashlib.sha1(indices.tobytes()).hexdigest()}]'
+    return f'{type(dataset).__name__}(root={getattr(dataset, "root", None)}, train={getattr(dataset, "train", None)}, len={len(dataset)})'
+
+
+def is_shared_valid(data_path, targets_path, source_path, data_shape, source):
+    # An existing memmap is reused only if it holds the same samples, with the expected shape and dtype
+    if not (os.path.exists(data_path) and os.path.exists(targets_path) and os.path.exists(source_path)):
+        return False
+    with open(source_path) as f:
+        if json.load(f).get('source') != source:
+            return False
+    data = np.load(data_path, mmap_mode='r')
+    targets = np.load(targets_path, mmap_mode='r')
+    return (data.shape == data_shape) and (data.dtype == np.float32) and \
+        (targets.shape == data_shape[:1]) and (targets.dtype == np.int64)
+
+
+def share_dataset(dataset, shared_folder, name):
+    data_path = os.path.join(shared_folder, f'{name}_data.npy')
+    targets_path = os.path.join(shared_folder, f'{name}_targets.npy')
+    source_path = os.path.join(shared_folder, f'{name}_source.json')
+
+    first_X, _ = dataset[0]
+    data_shape = (len(dataset), *first_X.shape)
+    source = get_dataset_source(dataset)
+
+    if not is_shared_valid(data_path, targets_path, source_path, data_shape, source):
+        os.makedirs(shared_folder, exist_ok=True)
+
+        data = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.float32, shape=data_shape)
+        targets = np.empty(len(dataset), dtype=np.int64)
+        for i in range(len(dataset)):
+            X, y = dataset[i]
+            data[i] = X.numpy()
+            targets[i] = y
+        data.flush()
+        del data
+
+        np.save(targets_path, targets)
+        os.replace(data_path + '.tmp', data_path)
+        with open(source_path, 'w') as f:
+            json.dump({'source': source}, f)
+
+    return MemmapTensorDataset(data_path, targets_path)
@@ -0,0 +1,42 @@
+import math
+
+import torch
+from torch.utils.data import Dataset
+
+
+class PreloadedTensorDataset(Dataset):
+    def __init__(self, data, targets, device=None):
+        # Decoded once: uint8 images (N, 1, H, W) and int64 targets, contiguous and resident on the device
+        self.data = data.contiguous().to(device)
+        self.targets = targets.long().contiguous().to(device)
+
+    def __getitem__(self, index):
+        return to_float_images(self.data[index]), self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+
+class TensorBatchLoader:
+    # DataLoader replacement for a PreloadedTensorDataset: batches are gathered with one index tensor, no per-sample work
+    def __init__(self, dataset: PreloadedTensorDataset, batch_size=32, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        num_samples = len(self.dataset)
+        device = self.dataset.targets.device
+        indexes = torch.randperm(num_samples, device=device) if self.shuffle else torch.arange(num_samples, device=device)
+
+        for start in range(0, num_samples, self.batch_size):
+            batch_indexes = indexes[start:start + self.batch_size]
+            yield to_float_images(self.dataset.data[batch_indexes]), self.dataset.targets[batch_indexes]
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+def to_float_images(data):
+    # Same scaling as torchvision ToTensor
+    return data.float().div_(255)
@@ -0,0 +1,94 @@
+import torch
+from torch import nn
+
+from utils.model.MLP import MLP
+
+
+class BatchedMLP(nn.Module):
+    def __init__(self, models):
+        super(BatchedMLP, self).__init__()
+        depths = {len(model.layer_sizes) for model in models}
+        if len(depths) != 1:
+            raise ValueError('BatchedMLP requires models with the same number of layers.')
+
+        self.num_models = len(models)
+        self.layer_sizes = [model.layer_sizes for model in models]
+        self.activations = [model.activation for model in models]
+
+        # Every layer is padded to the largest width among the models, padded units are masked to zero
+        max_sizes = [max(sizes[i] for sizes in self.layer_sizes) for i in range(len(self.layer_sizes[0]))]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for i in range(len(max_sizes) - 1):
+            self.weights.append(nn.Parameter(torch.zeros(self.num_models, max_sizes[i+1], max_sizes[i])))
+            self.biases.append(nn.Parameter(torch.zeros(self.num_models, max_sizes[i+1])))
+            self.register_buffer(f'unit_mask_{i}', torch.zeros(self.num_models, max_sizes[i+1]))
+
+        for index, model in enumerate(models):
+            self.load_model_state_dict(index, model.state_dict())
+            for i in range(len(max_sizes) - 1):
+                self.get_buffer(f'unit_mask_{i}')[index, :self.layer_sizes[index][i+1]] = 1
+
+        # Models sharing an activation type are activated together
+        self.activation_groups = {}
+        for index, activation in enumerate(self.activations):
+            self.activation_groups.setdefault(type(activation), (activation, []))[1].append(index)
+
+    def forward(self, x):
+        x = x.view(x.size(0), -1)
+        x = torch.einsum('bi,moi->mbo', x, self.weights[0]) + self.biases[0][:, None]
+
+        for i in range(1, len(self.weights)):
+            x = self._activate(x) * self.get_buffer(f'unit_mask_{i-1}')[:, None]
+            x = torch.baddbmm(self.biases[i][:, None], x, self.weights[i].transpose(1, 2))
+
+        return x    # (num_models, batch_size, max_output_size)
+
+    def _activate(self, x):
+        if len(self.activation_groups) == 1:
+            activation, _ = next(iter(self.activation_groups.values()))
+            return activation(x)
+
+        activated = torch.empty_like(x)
+        for activation, indexes in self.activation_groups.values():
+            activated[indexes] = activation(x[indexes])
+        return activated
+
+    def model_state_dict(self, index):
+        sizes = self.layer_sizes[index]
+        state_dict = {}
+        for i in range(len(sizes) - 1):
+            state_dict[f'layers.{i}.weight'] = self.weights[i][index, :sizes[i+1], :sizes[i]].detach().clone()
+            state_dict[f'layers.{i}.bias'] = self.biases[i][index, :sizes[i+1]].detach().clone()
+        return state_dict
+
+    def load_model_state_dict(self, index, state_dict):
+        sizes = self.layer_sizes[index]
+        with torch.no_grad():
+            for i in range(len(sizes) - 1):
+                self.weights[i][index, :sizes[i+1], :sizes[i]] = state_dict[f'layers.{i}.weight']
+                self.biases[i][index, :sizes[i+1]] = state_dict[f'layers.{i}.bias']
+
+    def get_model(self, index):
+        model = MLP(layer_sizes=self.layer_sizes[index], activation=self.activations[index])
+        model.load_state_dict(self.model_state_dict(index))
+        return model.to(self.weights[0].device)
+
+    def get_model_view(self, index):
+        return MLPView(self, index)
+
+    def get_network_architecture(self, index):
+        return self.layer_sizes[index]
+
+
+class MLPView:
+    # Single-model interface (state_dict, get_network_architecture) used by EarlyStopper and the Regularizer
+    def __init__(self, batched_model: BatchedMLP, index):
+        self.batched_model = batched_model
+        self.index = index
+
+    def state_dict(self):
+        return self.batched_model.model_state_dict(self.index)
+
+    def get_network_architecture(self):
+        return self.batched_model.get_network_architecture(self.index)
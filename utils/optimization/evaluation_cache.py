@@ -0,0 +1,152 @@
+import os
+import pickle
+import sqlite3
+from contextlib import contextmanager
+
+from optuna.distributions import CategoricalDistribution, IntDistribution
+
+from utils.optimization.fidelity import FIDELITY_ATTR
+
+
+class EvaluationCache:
+    def __init__(self, path=None, quantization=None, categorical_bounds=None):
+        self.path = path
+        self.quantization = quantization if quantization is not None else {}
+        self.categorical_bounds = categorical_bounds if categorical_bounds is not None else {}
+
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+
+        if self.path is not None:
+            self._init_db()
+
+    def __call__(self, objective_fn, trial, logger):
+        cached_score = self.lookup(trial, logger)
+        if cached_score is not None:
+            return cached_score
+
+        score = objective_fn(trial, logger)
+        self.store(trial, score)
+        return score
+
+    def lookup(self, trial, logger):
+        # Score of an already evaluated trial (its user attrs are replayed on the trial), None on a miss
+        hyperparameters = self._get_hyperparameters(trial)
+        key = self.build_key(hyperparameters, self._get_fidelity(trial))
+        cached = self.get(key) if hyperparameters else None
+        if cached is None:
+            return None
+
+        score, user_attrs = cached
+        if not hasattr(trial, 'hyperparameters'):
+            self._replay_relative_params(trial)
+        for attr_key, value in user_attrs.items():
+            trial.set_user_attr(attr_key, value)
+        logger.log(f"Cached evaluation reused for hyperparameters: {key}\n")
+        return score
+
+    def store(self, trial, score):
+        if not getattr(trial, 'is_pruned', False):
+            self.put(self.build_key(self._get_hyperparameters(trial, completed=True), self._get_fidelity(trial)), score, dict(trial.user_attrs))
+
+    def build_key(self, hyperparameters, fidelity=None):
+        decoded = dict(hyperparameters)
+
+        for name, bounds in self.categorical_bounds.items():
+            encodings = {key: decoded.pop(key) for key in bounds.keys() if key in decoded}
+            if encodings:
+                decoded[name] = max(encodings, key=encodings.get)
+
+        key = repr(sorted((name, self._quantize(name, value)) for name, value in decoded.items()))
+        return key if fidelity is None else f'{key}@{fidelity}'    # The same point at another budget is a different evaluation
+
+    def _quantize(self, name, value):
+        if isinstance(value, str):
+            return value
+
+        step = self.quantization.get(name) if isinstance(self.quantization, dict) else self.quantization
+        if step is None:
+            return float(value)
+        return round(round(float(value) / step) * step, 12)
+
+    @staticmethod
+    def _get_hyperparameters(trial, completed=False):
+        if hasattr(trial, 'hyperparameters'):     # PSOTrial
+            return trial.hyperparameters
+        if completed:                             # Optuna Trial
+            return trial.params
+        return trial.relative_params
+
+    @staticmethod
+    def _get_fidelity(trial):
+        if hasattr(trial, 'hyperparameters'):     # PSOTrial
+            return trial.fidelity
+        return trial.user_attrs.get(FIDELITY_ATTR)
+
+    @staticmethod
+    def _replay_relative_params(trial):
+        # Optuna only records params through suggest calls, which a cache hit skips
+        for name, distribution in trial.relative_search_space.items():
+            if isinstance(distribution, CategoricalDistribution):
+                trial.suggest_categorical(name, distribution.choices)
+            elif isinstance(distribution, IntDistribution):
+                trial.suggest_int(name, distribution.low, distribution.high, step=distribution.step, log=distribution.log)
+            else:
+                trial.suggest_float(name, distribution.low, distribution.high, step=distribution.step, log=distribution.log)
+
+    def get(self, key):
+        if self.path is None:
+            cached = self._memory.get(key)
+        else:
+            with self._connect() as connection:
+                row = connection.execute('SELECT value FROM evaluations WHERE key = ?', (key,)).fetchone()
+            cached = pickle.loads(row[0]) if row is not None else None
+
+        self._count(hit=cached is not None)
+        return cached
+
+    def put(self, key, score, user_attrs):
+        if self.path is None:
+            self._memory[key] = (score, user_attrs)
+            return
+
+        value = pickle.dumps((score, user_attrs), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO evaluations (key, value) VALUES (?, ?)', (key, value))
+
+    def get_counters(self):
+        if self.path is None:
+            return {'hits': self.hits, 'misses': self.misses}
+        with self._connect() as connection:
+            return dict(connection.execute('SELECT name, value FROM counters').fetchall())
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        if self.path is not None:
+            with self._connect() as connection:
+                connection.execute('UPDATE counters SET value = value + 1 WHERE name = ?', ('hits' if hit else 'misses',))
+
+    def _init_db(self):
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, value BLOB)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('hits', 0), ('misses', 0)")
+
+    @contextmanager
+    def _connect(self):
+        # Shared by joblib/loky workers and by later sessions through the same file
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
@@ -0,0 +1,49 @@
+import numpy as np
+
+FIDELITY_ATTR = 'fidelity'
+
+
+class FidelitySchedule:
+    def __init__(self, min_fidelity, max_fidelity, eta=3, ramp_generations=None):
+        if min_fidelity > max_fidelity:
+            raise ValueError(f"Min fidelity {min_fidelity} is greater than max fidelity {max_fidelity}.")
+
+        self.min_fidelity = min_fidelity
+        self.max_fidelity = max_fidelity
+        self.eta = eta
+        self.ramp_generations = ramp_generations    # Generations spent on each base rung, None keeps the lowest rung
+
+        self.fidelities = self._build_fidelities()
+
+    def _build_fidelities(self):
+        # Rungs are built down from the full budget: max, max/eta, max/eta^2, ... >= min
+        fidelities = []
+        fidelity = self.max_fidelity
+        while fidelity >= self.min_fidelity:
+            fidelities.append(round(fidelity) if isinstance(self.max_fidelity, int) else fidelity)
+            fidelity /= self.eta
+        return sorted(set(fidelities))
+
+    def base_fidelity(self, generation):
+        if self.ramp_generations is None:
+            return self.fidelities[0]
+        return self.fidelities[min((generation - 1) // self.ramp_generations, len(self.fidelities) - 1)]
+
+    def next_fidelity(self, fidelity):
+        index = self.fidelities.index(fidelity)
+        return self.fidelities[index + 1] if index + 1 < len(self.fidelities) else None
+
+    def n_promoted(self, n):
+        return max(n // self.eta, 1)
+
+    def rank_fidelity(self, generation, rank, n):
+        # Steady-state variant: a particle ranked in the top n/eta^k of the swarm is promoted k rungs above the base one
+        level = 0
+        while (level + 1 < len(self.fidelities)) and (rank < n / (self.eta ** (level + 1))):
+            level += 1
+        base_index = self.fidelities.index(self.base_fidelity(generation))
+        return self.fidelities[min(base_index + level, len(self.fidelities) - 1)]
+
+    @staticmethod
+    def rank(scores, index):
+        return int(np.sum(np.asarray(scores) > scores[index]))
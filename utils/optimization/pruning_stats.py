@@ -0,0 +1,134 @@
+import heapq
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:     # Windows: single O_APPEND writes of a whole record are relied upon instead
+    fcntl = None
+
+
+class RunningMedian:
+    def __init__(self):
+        self._low = []    # Max-heap (negated values) holding the lower half
+        self._high = []   # Min-heap holding the upper half
+
+    def push(self, value):
+        if (not self._low) or (value <= -self._low[0]):
+            heapq.heappush(self._low, -value)
+        else:
+            heapq.heappush(self._high, value)
+
+        if len(self._low) > len(self._high) + 1:
+            heapq.heappush(self._high, -heapq.heappop(self._low))
+        elif len(self._high) > len(self._low):
+            heapq.heappush(self._low, -heapq.heappop(self._high))
+
+    def median(self):
+        if len(self._low) > len(self._high):
+            return -self._low[0]
+        return (-self._low[0] + self._high[0]) / 2
+
+    def values(self):
+        # Every pushed value, best (highest) first
+        return sorted([-value for value in self._low] + self._high, reverse=True)
+
+    def __len__(self):
+        return len(self._low) + len(self._high)
+
+
+class PruningStatsStore:
+    RECORD = struct.Struct('<qd')   # (step, score)
+
+    def __init__(self, path=None):
+        self.path = None
+        self.medians = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+
+        if path is not None:
+            self.share(path)
+
+    def share(self, path):
+        # Reports pushed so far stay in this store (and in its pickled copies), the next ones go to the file
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+
+    def report(self, score, step):
+        with self._lock:
+            if self.path is None:
+                self._push(step, score)
+                return
+
+            # Appended to the shared file only: every process (this one included) reads it back in _sync
+            with open(self.path, 'ab') as fout:
+                self._lock_file(fout)
+                fout.write(self.RECORD.pack(step, score))
+
+    def median(self, step):
+        self._sync()
+        return self.medians[step].median() if step in self.medians else None
+
+    def count(self, step):
+        self._sync()
+        return len(self.medians[step]) if step in self.medians else 0
+
+    def values(self, step):
+        self._sync()
+        return self.medians[step].values() if step in self.medians else []
+
+    def file_offset(self):
+        # End of the last whole record in the shared file, saved by checkpoints to drop the later reports on resume
+        if (self.path is None) or (not os.path.exists(self.path)):
+            return 0
+        size = os.path.getsize(self.path)
+        return size - (size % self.RECORD.size)
+
+    def truncate(self, offset):
+        if (self.path is None) or (not os.path.exists(self.path)):
+            return
+        with self._lock:
+            with open(self.path, 'r+b') as fout:
+                self._lock_file(fout)
+                if os.fstat(fout.fileno()).st_size > offset:
+                    fout.truncate(offset)
+            self._offset = min(self._offset, offset)
+
+    def _push(self, step, score):
+        if step not in self.medians:
+            self.medians[step] = RunningMedian()
+        self.medians[step].push(score)
+
+    def _sync(self):
+        if (self.path is None) or (not os.path.exists(self.path)):
+            return
+
+        with self._lock:
+            # Only the records appended since the last sync are read, each costs one O(log n) heap push
+            with open(self.path, 'rb') as fin:
+                self._lock_file(fin, shared=True)
+                fin.seek(self._offset)
+                data = fin.read()
+
+            n_records = len(data) // self.RECORD.size
+            for step, score in self.RECORD.iter_unpack(data[:n_records * self.RECORD.size]):
+                self._push(step, score)
+            self._offset += n_records * self.RECORD.size
+
+    @staticmethod
+    def _lock_file(file, shared=False):
+        # Released when the file is closed
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,103 @@
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+
+SURROGATE_MODELS = ('random_forest', 'gaussian_process')
+SCREENING_MODES = ('replace', 'skip')
+
+
+class SurrogateScreener:
+    def __init__(self, model='random_forest', min_observations=16, poor_quantile=0.25, exploration_fraction=0.2,
+                 mode='replace', n_candidates=64, candidate_scale=0.1):
+        if model not in SURROGATE_MODELS:
+            raise ValueError(f"Surrogate model {model} not supported.")
+        if mode not in SCREENING_MODES:
+            raise ValueError(f"Screening mode {mode} not supported.")
+
+        self.model = model
+        self.min_observations = min_observations
+        self.poor_quantile = poor_quantile
+        self.exploration_fraction = exploration_fraction    # Share of the poor positions evaluated anyway
+        self.mode = mode
+        self.n_candidates = n_candidates
+        self.candidate_scale = candidate_scale
+
+        self.positions = []
+        self.scores = []
+
+        self.n_screened = 0
+        self.n_replaced = 0
+        self.n_skipped = 0
+
+        self._regressor = None
+        self._n_fitted = 0
+
+    def add(self, positions, scores):
+        for position, score in zip(np.atleast_2d(positions), np.atleast_1d(scores)):
+            if np.isfinite(score):
+                self.positions.append(np.array(position, dtype=float))
+                self.scores.append(float(score))
+
+    def is_ready(self):
+        return len(self.scores) >= self.min_observations
+
+    def screen(self, positions, bounds):
+        self._fit(bounds)
+        positions = np.array(positions, dtype=float)
+
+        # Clearly poor: even the optimistic estimate falls below the poor_quantile of the observed scores
+        mean, std = self.predict(positions, bounds)
+        poor = (mean + std) < np.quantile(self.scores, self.poor_quantile)
+        poor &= np.random.uniform(size=len(poor)) >= self.exploration_fraction
+        self.n_screened += len(poor)
+
+        if self.mode == 'skip':
+            self.n_skipped += int(poor.sum())
+            return positions, poor
+
+        for index in np.flatnonzero(poor):
+            positions[index] = self._best_candidate(positions[index], bounds)
+        self.n_replaced += int(poor.sum())
+        return positions, np.zeros(len(positions), dtype=bool)
+
+    def predict(self, positions, bounds):
+        X = self._normalize(np.atleast_2d(positions), bounds)
+        if self.model == 'gaussian_process':
+            return self._regressor.predict(X, return_std=True)
+
+        tree_predictions = np.stack([tree.predict(X) for tree in self._regressor.estimators_])
+        return tree_predictions.mean(axis=0), tree_predictions.std(axis=0)
+
+    def get_counters(self):
+        return {'screened': self.n_screened, 'replaced': self.n_replaced, 'skipped': self.n_skipped}
+
+    def _fit(self, bounds):
+        if (self._regressor is not None) and (self._n_fitted == len(self.scores)):
+            return
+
+        self._regressor = self._build_regressor()
+        self._regressor.fit(self._normalize(np.array(self.positions), bounds), np.array(self.scores))
+        self._n_fitted = len(self.scores)
+
+    def _build_regressor(self):
+        random_state = np.random.randint(2**31 - 1)
+        if self.model == 'gaussian_process':
+            kernel = ConstantKernel() * Matern(nu=2.5) + WhiteKernel()
+            return GaussianProcessRegressor(kernel=kernel, normalize_y=True, random_state=random_state)
+        return RandomForestRegressor(n_estimators=100, min_samples_leaf=2, random_state=random_state)
+
+    def _best_candidate(self, position, bounds):
+        # Half local perturbations, half uniform samples of the whole space, ranked by upper confidence bound
+        n_local = self.n_candidates // 2
+        widths = bounds[:, 1] - bounds[:, 0]
+        local_candidates = position + np.random.normal(0, self.candidate_scale, size=(n_local, len(position))) * widths
+        uniform_candidates = np.random.uniform(bounds[:, 0], bounds[:, 1], size=(self.n_candidates - n_local, len(position)))
+        candidates = np.clip(np.concatenate([local_candidates, uniform_candidates]), bounds[:, 0], bounds[:, 1])
+
+        mean, std = self.predict(candidates, bounds)
+        return candidates[np.argmax(mean + std)]
+
+    @staticmethod
+    def _normalize(positions, bounds):
+        return (positions - bounds[:, 0]) / np.maximum(bounds[:, 1] - bounds[:, 0], 1e-12)
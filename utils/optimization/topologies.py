@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class BaseTopology:
+    def __init__(self):
+        self._neighbourhoods = None
+
+    def get_neighbourhoods(self, num_particles):
+        if (self._neighbourhoods is None) or (self._neighbourhoods.shape[0] != num_particles):
+            self._neighbourhoods = self.build_neighbourhoods(num_particles)
+        return self._neighbourhoods
+
+    def build_neighbourhoods(self, num_particles):
+        raise NotImplementedError
+
+    def next_generation(self):
+        pass
+
+    def best_positions(self, personal_best_positions, personal_best_scores, global_best_position):
+        neighbourhoods = self.get_neighbourhoods(personal_best_scores.shape[0])
+        best_columns = np.argmax(personal_best_scores[neighbourhoods], axis=1)
+        best_indexes = neighbourhoods[np.arange(neighbourhoods.shape[0]), best_columns]
+        return personal_best_positions[best_indexes]
+
+    def best_position(self, index, personal_best_positions, personal_best_scores, global_best_position):
+        neighbourhood = self.get_neighbourhoods(personal_best_scores.shape[0])[index]
+        return personal_best_positions[neighbourhood[np.argmax(personal_best_scores[neighbourhood])]]
+
+
+class StarTopology(BaseTopology):
+    def best_positions(self, personal_best_positions, personal_best_scores, global_best_position):
+        return global_best_position
+
+    def best_position(self, index, personal_best_positions, personal_best_scores, global_best_position):
+        return global_best_position
+
+
+class RingTopology(BaseTopology):
+    def __init__(self, k=1):
+        super().__init__()
+        self.k = k
+
+    def build_neighbourhoods(self, num_particles):
+        offsets = np.arange(-self.k, self.k + 1)
+        return (np.arange(num_particles)[:, None] + offsets[None, :]) % num_particles
+
+
+class VonNeumannTopology(BaseTopology):
+    def build_neighbourhoods(self, num_particles):
+        rows = max(int(np.sqrt(num_particles)), 1)
+        cols = int(np.ceil(num_particles / rows))
+
+        indexes = np.arange(num_particles)
+        r, c = indexes // cols, indexes % cols
+        neighbours = [
+            indexes,
+            ((r - 1) % rows) * cols + c,
+            ((r + 1) % rows) * cols + c,
+            r * cols + (c - 1) % cols,
+            r * cols + (c + 1) % cols,
+        ]
+        return np.stack(neighbours, axis=1) % num_particles
+
+
+class RandomTopology(BaseTopology):
+    def __init__(self, k=3, period=1):
+        super().__init__()
+        self.k = k
+        self.period = period
+        self._generation_count = 0
+
+    def build_neighbourhoods(self, num_particles):
+        informants = np.random.randint(0, num_particles, size=(num_particles, self.k))
+        return np.concatenate([np.arange(num_particles)[:, None], informants], axis=1)
+
+    def next_generation(self):
+        self._generation_count += 1
+        if self._generation_count % self.period == 0:
+            self._neighbourhoods = None
+
+
+TOPOLOGIES = {
+    'star': StarTopology,
+    'ring': RingTopology,
+    'von_neumann': VonNeumannTopology,
+    'random': RandomTopology,
+}
+
+
+def get_topology(topology):
+    if topology is None:
+        return StarTopology()
+    if isinstance(topology, str):
+        if topology not in TOPOLOGIES:
+            raise ValueError(f"Topology {topology} not supported.")
+        return TOPOLOGIES[topology]()
+    return topology
@@ -1,4 +1,5 @@
 import pickle
+from functools import partial
 
 from optuna import Study
 
@@ -27,9 +28,15 @@ class OptunaRunner:
             folder_exists_check(self.path_txt, self.session_num, f'log_{study_str}')
         logger_study = Logger(file_name_builder(self.path_txt, self.session_num, f'log_{study_str}', 'txt'))
 
+        # Wrap Objective with the Sampler Evaluation Cache (if any)
+        objective_fn = self.objective_fn
+        evaluation_cache = getattr(study.sampler, 'evaluation_cache', None)
+        if evaluation_cache is not None:
+            objective_fn = partial(evaluation_cache, self.objective_fn)
+
         # Run Optimization
         try:
-            study.optimize(lambda trail: self.objective_fn(trail, logger_study), n_trials=self.n_trials, n_jobs=self.n_jobs)
+            study.optimize(lambda trail: objective_fn(trail, logger_study), n_trials=self.n_trials, n_jobs=self.n_jobs)
         except Exception as e:
             logger_study.err(e)
             return None
@@ -43,6 +50,8 @@ class OptunaRunner:
         logger_study.log(f"Trial {self.metric_to_follow}-score:  {study.best_trial.user_attrs[self.metric_to_follow]}")
         logger_study.log(f"Best score:            {study.best_trial.value}")
         logger_study.log(f"Best hyperparameters:  {study.best_params}")
+        if evaluation_cache is not None:
+            logger_study.log(f"Evaluation cache:      {evaluation_cache.get_counters()}")
 
         logger_study.end_log()
 
@@ -1,5 +1,14 @@
+import threading
+import time
+import warnings
+from contextlib import contextmanager
 from typing import Sequence
 
+try:
+    import fcntl
+except ImportError:     # Windows: only the in-process lock guards the particle claims
+    fcntl = None
+
 import numpy as np
 from optuna import Study
 from optuna.distributions import BaseDistribution
@@ -8,12 +17,45 @@ from optuna.samplers import BaseSampler, RandomSampler
 from optuna.search_space import IntersectionSearchSpace
 from optuna.trial import FrozenTrial, TrialState
 
+from experiments.PSO_experiment.backend.pso_utils import LOG_SCALE, INT_SCALE, INT_LOG_SCALE, encode_bound, decode_value
+from utils.optimization.fidelity import FIDELITY_ATTR
+from utils.optimization.topologies import get_topology
+
+# Study/trial system attrs holding the swarm state in the Optuna storage
+PARTICLE_ATTR_PREFIX = 'pso:particle_'
+GLOBAL_BEST_ATTR = 'pso:global_best'
+POSITION_ATTR = 'pso:position'
+CLAIM_ATTR_PREFIX = 'pso:claim_'        # Trial id of the running trial that owns the particle
+PENDING_ATTR_PREFIX = 'pso:pending_'    # Constant liar value of the owning trial, until its real value is told
+GENERATION_ATTR_PREFIX = 'pso:generation_'  # Last generation of a particle run by a startup (random) trial
+COMPLETED_STATS_ATTR = 'pso:completed_stats'    # Running count/sum/min/max of the completed values, for the liar
+
 
 class PSOSampler(BaseSampler):
-    def __init__(self, num_particles: int, max_generations: int):
+    def __init__(self, num_particles: int, max_generations: int, evaluation_cache=None, topology=None,
+                 parallel: bool = False, constant_liar: str | None = None, pending_timeout: float | None = None, pending_poll_interval: float = 1.0,
+                 claim_lock_path: str | None = None, fidelity_schedule=None, surrogate=None):
         super().__init__()
         self.num_particles = num_particles
         self.max_generations = max_generations
+        self.evaluation_cache = evaluation_cache   # Applied around the objective by OptunaRunner
+        self.topology = get_topology(topology)
+        self.fidelity_schedule = fidelity_schedule   # The objective reads the budget from trial.user_attrs['fidelity']
+
+        # Optuna runs every sampled trial, so clearly poor positions can only be replaced, never skipped
+        if (surrogate is not None) and (surrogate.mode != 'replace'):
+            raise ValueError('PSOSampler only supports the replace surrogate screening mode.')
+        self.surrogate = surrogate
+
+        # Parallel mode: a particle with a running trial is never sampled again until that trial is told.
+        # Claims are made under a lock: the in-process one for threads, plus a file lock for several processes.
+        self.parallel = parallel
+        self.constant_liar = constant_liar     # None (no pending values), 'worst', 'mean' or 'best'
+        self.pending_timeout = pending_timeout
+        self.pending_poll_interval = pending_poll_interval
+        self.claim_lock_path = claim_lock_path
+        self._claim_lock = threading.Lock()
+        self.pending = {}   # particle_id -> (liar score, position) of the running trials
 
         self.hps_bounds = []
         self.bounds = None
@@ -23,64 +65,203 @@ class PSOSampler(BaseSampler):
         self.global_best_position = None
 
         self._search_space = IntersectionSearchSpace(include_pruned=True)
+        self._fixed_search_space = None   # Frozen after the startup generation, avoids scanning the study for every trial
         self._n_startup_trials = num_particles
         self._random_sampler = RandomSampler()   # For the first n_startup_trials
 
     def before_trial(self, study: Study, trial: FrozenTrial):
-        current_gen = self._get_trial_current_generation(trial)
-        particle_id = self._get_trial_particle_id(trial)
+        if self.parallel:
+            particle_id, current_gen = self._claim_particle(study, trial)
+        else:
+            particle_id, current_gen = self._get_trial_particle_id(trial), self._get_trial_current_generation(trial)
 
         trial.system_attrs['generation'] = current_gen
         trial.system_attrs['particle'] = particle_id
+        study._storage.set_trial_system_attr(trial._trial_id, 'generation', current_gen)
+        study._storage.set_trial_system_attr(trial._trial_id, 'particle', particle_id)
+
+        if self.fidelity_schedule is not None:
+            fidelity = self._get_trial_fidelity(study, particle_id, current_gen)
+            trial.user_attrs[FIDELITY_ATTR] = fidelity
+            study._storage.set_trial_user_attr(trial._trial_id, FIDELITY_ATTR, fidelity)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_claim_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._claim_lock = threading.Lock()
+
+    def _get_trial_fidelity(self, study: Study, particle_id: int, current_gen: int):
+        if self.bounds is None:
+            return self.fidelity_schedule.base_fidelity(current_gen)
+
+        # Particles are ranked by personal best: only the promising ones are given a larger budget
+        self._load_swarm(study)
+        personal_best_scores = [self.swarm[i+1].personal_best_score for i in range(self.num_particles)]
+        rank = self.fidelity_schedule.rank(personal_best_scores, particle_id-1)
+        return self.fidelity_schedule.rank_fidelity(current_gen, rank, self.num_particles)
 
     def _get_trial_current_generation(self, trial: FrozenTrial):
+        if 'generation' in trial.system_attrs:
+            return trial.system_attrs['generation']
         return (trial.number // self.num_particles) + 1
 
     def _get_trial_particle_id(self, trial: FrozenTrial):
+        if 'particle' in trial.system_attrs:
+            return trial.system_attrs['particle']
         return (trial.number % self.num_particles) + 1
 
+    def _claim_particle(self, study: Study, trial: FrozenTrial):
+        default_id = (trial.number % self.num_particles) + 1
+
+        start_time = time.time()
+        while True:
+            with self._claim_guard():
+                system_attrs = study._storage.get_study_system_attrs(study._study_id)
+                free_ids = [i+1 for i in range(self.num_particles)
+                            if not self._is_claimed(study, system_attrs.get(f'{CLAIM_ATTR_PREFIX}{i+1}'))]
+
+                if free_ids:
+                    particle_id = default_id if default_id in free_ids else \
+                        min(free_ids, key=lambda i: self._get_stored_generation(system_attrs, i))
+                    study._storage.set_study_system_attr(study._study_id, f'{CLAIM_ATTR_PREFIX}{particle_id}', trial._trial_id)
+                    current_gen = self._get_stored_generation(system_attrs, particle_id) + 1
+                    break
+
+            if (self.pending_timeout is not None) and (time.time() - start_time > self.pending_timeout):
+                study._storage.set_trial_state_values(trial._trial_id, TrialState.FAIL)
+                raise RuntimeError(f"No free particle for trial {trial.number} after {self.pending_timeout} seconds.")
+            time.sleep(self.pending_poll_interval)
+
+        if (self.constant_liar is not None) and (self.bounds is not None):
+            self._set_pending_liar(study, particle_id, trial)
+        return particle_id, current_gen
+
+    @contextmanager
+    def _claim_guard(self):
+        with self._claim_lock:
+            if (self.claim_lock_path is None) or (fcntl is None):
+                yield
+                return
+            with open(self.claim_lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _is_claimed(study: Study, owner_trial_id):
+        # Claims of finished (or vanished) trials are stale
+        if owner_trial_id is None:
+            return False
+        try:
+            return study._storage.get_trial(owner_trial_id).state == TrialState.RUNNING
+        except KeyError:
+            return False
+
+    @staticmethod
+    def _get_stored_generation(system_attrs: dict, particle_id: int):
+        particle_data = system_attrs.get(f'{PARTICLE_ATTR_PREFIX}{particle_id}')
+        particle_generation = particle_data.get('generation', 0) if particle_data is not None else 0
+        return max(particle_generation, system_attrs.get(f'{GENERATION_ATTR_PREFIX}{particle_id}', 0))
+
+    def _release_particle(self, study: Study, trial: FrozenTrial):
+        particle_id = trial.system_attrs.get('particle')
+        if particle_id is None:
+            return
+
+        with self._claim_guard():
+            system_attrs = study._storage.get_study_system_attrs(study._study_id)
+            pending = system_attrs.get(f'{PENDING_ATTR_PREFIX}{particle_id}')
+            if (pending is not None) and (pending['trial_id'] == trial._trial_id):
+                study._storage.set_study_system_attr(study._study_id, f'{PENDING_ATTR_PREFIX}{particle_id}', None)
+            if system_attrs.get(f'{CLAIM_ATTR_PREFIX}{particle_id}') == trial._trial_id:
+                study._storage.set_study_system_attr(study._study_id, f'{CLAIM_ATTR_PREFIX}{particle_id}', None)
+
+    def _set_pending_liar(self, study: Study, particle_id: int, trial: FrozenTrial):
+        # Temporary value of the running trial: it only guides the other particles' social best, the personal and
+        # global bests keep measured values only, and it is dropped when the real value is told
+        stats = study._storage.get_study_system_attrs(study._study_id).get(COMPLETED_STATS_ATTR)
+        if stats is None:
+            return
+
+        liar_strategies = {'worst': stats['min'], 'mean': stats['sum'] / stats['count'], 'best': stats['max']}
+        self._load_swarm(study)
+        study._storage.set_study_system_attr(study._study_id, f'{PENDING_ATTR_PREFIX}{particle_id}',
+                                             {'trial_id': trial._trial_id,
+                                              'score': float(liar_strategies[self.constant_liar]),
+                                              'position': self.swarm[particle_id].position.tolist()})
+
+    def _update_completed_stats(self, study: Study, value: float):
+        # Kept up to date as trials complete, so a claim never scans the whole study
+        value = float(value)
+        with self._claim_guard():
+            stats = study._storage.get_study_system_attrs(study._study_id).get(COMPLETED_STATS_ATTR)
+            if stats is None:
+                stats = {'count': 1, 'sum': value, 'min': value, 'max': value}
+            else:
+                stats = {'count': stats['count'] + 1, 'sum': stats['sum'] + value,
+                         'min': min(stats['min'], value), 'max': max(stats['max'], value)}
+            study._storage.set_study_system_attr(study._study_id, COMPLETED_STATS_ATTR, stats)
+
     def infer_relative_search_space(self, study: Study, trial: FrozenTrial):
-        return self._search_space.calculate(study)
+        if self._fixed_search_space is not None:
+            return dict(self._fixed_search_space)
+
+        search_space = self._search_space.calculate(study)
+        if (trial.number >= self._n_startup_trials) and (search_space != {}):
+            self._fixed_search_space = search_space
+        return search_space
+
+    def _check_fixed_search_space(self, trial: FrozenTrial, state: TrialState):
+        # Incremental check: only the finished trial is compared against the frozen search space
+        if (self._fixed_search_space is None) or (state not in (TrialState.COMPLETE, TrialState.PRUNED)):
+            return
+
+        for name, distribution in self._fixed_search_space.items():
+            if trial.distributions.get(name) != distribution:
+                warnings.warn(f"Trial {trial.number} changed the distribution of {name}, the search space will be inferred again.")
+                self._fixed_search_space = None
+                return
 
     def sample_relative(self, study: Study, trial: FrozenTrial, search_space: dict[str, BaseDistribution]):
         if search_space == {}:
             return {}
 
-        if self.swarm is None:
-            self._init_swarm(search_space)
+        if self.bounds is None:
+            self._init_bounds(search_space)
+
+        self._load_swarm(study)
+
+        particle = self.swarm[self._get_trial_particle_id(trial)]
+        if (self.surrogate is not None) and self.surrogate.is_ready():
+            positions, _ = self.surrogate.screen(particle.position[None], self.bounds)
+            particle.position = positions[0]
+            self._store_particle(study, particle)
+        study._storage.set_trial_system_attr(trial._trial_id, POSITION_ATTR, particle.position.tolist())
 
         return self._sample(trial)
 
     def sample_independent(self, study: Study, trial: FrozenTrial, param_name: str, param_distribution: BaseDistribution):
-        if trial.number < self._n_startup_trials:
+        if (trial.number < self._n_startup_trials) or (self.bounds is None):   # No completed trial defines the swarm yet
             return self._random_sampler.sample_independent(study, trial, param_name, param_distribution)
         raise NotImplementedError('Independent sampling is not supported for PSO.')
 
     def _sample(self, trial: FrozenTrial):
-        particle = self.swarm[self._get_trial_particle_id(trial)]
+        position = self.swarm[self._get_trial_particle_id(trial)].position
 
-        hyperparameters = {}
-        categorical_hps = {}
-        for position, hp in zip(particle.position, self.hps_bounds):
-            if isinstance(hp.distribution, CategoricalDistribution):
-                if hp.categorical_id not in categorical_hps:
-                    categorical_hps[hp.categorical_id] = []
-                categorical_hps[hp.categorical_id].append((hp.name, position))
-            elif isinstance(hp.distribution, IntDistribution):
-                hyperparameters[hp.name] = hp.round_to_nearest_low_multiple(position)
-            elif isinstance(hp.distribution, FloatDistribution):
-                hyperparameters[hp.name] = position
-            else:
-                raise ValueError('Invalid distribution type')
+        hyperparameters = {hp.name: hp.decode(position[i]) for i, hp in self._numeric_hps}
 
-        for key, value in categorical_hps.items():
-            index = np.argmax([t[1] for t in value])
-            name = value[index][0]
-            hyperparameters[key] = name
+        for categorical_id, indexes, choices in self._categorical_groups:
+            hyperparameters[categorical_id] = choices[np.argmax(position[indexes])]
 
         return hyperparameters
 
-    def _init_swarm(self, search_space: dict[str, BaseDistribution]):
+    def _init_bounds(self, search_space: dict[str, BaseDistribution]):
         for name, distribution in search_space.items():
             if isinstance(distribution, CategoricalDistribution):
                 for choice in distribution.choices:
@@ -89,8 +270,43 @@ class PSOSampler(BaseSampler):
                 self.hps_bounds.append(_HPBound(name, distribution))
 
         self.bounds = np.array([[hp.low, hp.high] for hp in self.hps_bounds])
+        self._build_decoding_tables()
+
+    def _build_decoding_tables(self):
+        # Built once per search space, so decoding a position does not depend on the number of trials
+        self._numeric_hps = [(i, hp) for i, hp in enumerate(self.hps_bounds) if not isinstance(hp.distribution, CategoricalDistribution)]
+
+        categorical_groups = {}
+        for i, hp in enumerate(self.hps_bounds):
+            if isinstance(hp.distribution, CategoricalDistribution):
+                categorical_groups.setdefault(hp.categorical_id, []).append((i, hp.name))
+        self._categorical_groups = [(categorical_id, np.array([i for i, _ in group]), [name for _, name in group])
+                                    for categorical_id, group in categorical_groups.items()]
+
+    def _load_swarm(self, study: Study):
+        system_attrs = study._storage.get_study_system_attrs(study._study_id)
 
-        self.swarm = {i+1: Particle(self.bounds, particle_id=i+1) for i in range(self.num_particles)}
+        missing_ids = [i+1 for i in range(self.num_particles) if f'{PARTICLE_ATTR_PREFIX}{i+1}' not in system_attrs]
+        if missing_ids:
+            for particle_id in missing_ids:
+                self._store_particle(study, Particle(self.bounds, particle_id=particle_id))
+            # Re-read: another worker may be initializing the swarm concurrently
+            system_attrs = study._storage.get_study_system_attrs(study._study_id)
+
+        self.swarm = {i+1: Particle.from_dict(system_attrs[f'{PARTICLE_ATTR_PREFIX}{i+1}']) for i in range(self.num_particles)}
+
+        if GLOBAL_BEST_ATTR in system_attrs:
+            self.global_best_score = system_attrs[GLOBAL_BEST_ATTR]['score']
+            self.global_best_position = np.array(system_attrs[GLOBAL_BEST_ATTR]['position'])
+
+        self.pending = {}
+        for i in range(self.num_particles):
+            pending = system_attrs.get(f'{PENDING_ATTR_PREFIX}{i+1}')
+            if pending is not None:
+                self.pending[i+1] = (pending['score'], np.array(pending['position']))
+
+    def _store_particle(self, study: Study, particle):
+        study._storage.set_study_system_attr(study._study_id, f'{PARTICLE_ATTR_PREFIX}{particle.particle_id}', particle.to_dict())
 
     def _inertia_factor_update(self, current_iter: int):
         return (0.4 * ((current_iter - self.max_generations) / (self.max_generations ** 2))) + 0.4
@@ -102,34 +318,93 @@ class PSOSampler(BaseSampler):
         return (3 * (current_iter / self.max_generations)) + 0.5
 
     def after_trial(self, study: Study, trial: FrozenTrial, state: TrialState, values: Sequence[float] | None):
-        if self.swarm is None:
+        self._check_fixed_search_space(trial, state)
+
+        if self.parallel and (self.constant_liar is not None) and (state == TrialState.COMPLETE) and (values is not None):
+            self._update_completed_stats(study, values[0])
+
+        # The particle is released only once its update is stored, so the next trial samples the new position
+        try:
+            self._tell_particle(study, trial, state, values)
+        finally:
+            if self.parallel:
+                self._release_particle(study, trial)
+
+    def _tell_particle(self, study: Study, trial: FrozenTrial, state: TrialState, values: Sequence[float] | None):
+        if POSITION_ATTR not in trial.system_attrs:
+            # Startup trials do not move the particle (which may not exist yet), but they are one of its generations
+            if self.parallel and ('particle' in trial.system_attrs):
+                self._store_startup_generation(study, trial.system_attrs['particle'], self._get_trial_current_generation(trial))
+            return
+        if (self.bounds is None) or (values is None):
             return
 
         current_gen = self._get_trial_current_generation(trial)
         particle_id = self._get_trial_particle_id(trial)
 
+        self._load_swarm(study)
         particle = self.swarm[particle_id]
 
         fitness = values[0]
+        position = np.array(trial.system_attrs[POSITION_ATTR])
+
+        if self.surrogate is not None:
+            self.surrogate.add(position, fitness)   # Trials of this process only
 
         if (state == TrialState.COMPLETE) or (self.global_best_position is None):
-            self._update_best_positions(particle, fitness)
+            self._update_best_positions(study, particle, position, fitness)
 
         w = self._inertia_factor_update(current_iter=current_gen-1)
         c1 = self._cognitive_factor_update(current_iter=current_gen-1)
         c2 = self._social_factor_update(current_iter=current_gen-1)
 
-        particle.update_velocity(self.global_best_position, w, c1, c2)
-        particle.update_position(self.bounds)
+        if particle_id == self.num_particles:
+            self.topology.next_generation()
 
-    def _update_best_positions(self, particle, fitness):
+        particle.update_velocity(self._get_social_best_position(particle_id), w, c1, c2)
+        particle.update_position(self.bounds)
+        particle.generation = max(particle.generation, current_gen)
+
+        self._store_particle(study, particle)
+
+    def _store_startup_generation(self, study: Study, particle_id: int, generation: int):
+        with self._claim_guard():
+            system_attrs = study._storage.get_study_system_attrs(study._study_id)
+            if generation > system_attrs.get(f'{GENERATION_ATTR_PREFIX}{particle_id}', 0):
+                study._storage.set_study_system_attr(study._study_id, f'{GENERATION_ATTR_PREFIX}{particle_id}', generation)
+
+    def _get_social_best_position(self, particle_id: int):
+        personal_best_positions = np.array([self.swarm[i+1].personal_best_position for i in range(self.num_particles)])
+        personal_best_scores = np.array([self.swarm[i+1].personal_best_score for i in range(self.num_particles)])
+        global_best_score, global_best_position = self.global_best_score, self.global_best_position
+
+        # Pending liar values of the other particles' running trials count as if already measured
+        for other_id, (score, position) in self.pending.items():
+            if other_id == particle_id:
+                continue
+            if score > personal_best_scores[other_id-1]:
+                personal_best_scores[other_id-1] = score
+                personal_best_positions[other_id-1] = position
+            if score > global_best_score:
+                global_best_score, global_best_position = score, position
+
+        return self.topology.best_position(particle_id-1, personal_best_positions, personal_best_scores, global_best_position)
+
+    def _update_best_positions(self, study: Study, particle, position, fitness):
         if fitness > particle.personal_best_score:
             particle.personal_best_score = fitness
-            particle.personal_best_position = np.copy(particle.position)
+            particle.personal_best_position = np.copy(position)
 
         if fitness > self.global_best_score:
             self.global_best_score = fitness
-            self.global_best_position = np.copy(particle.position)
+            self.global_best_position = np.copy(position)
+
+            # Read-compare-write under the guard, so a concurrent better best is never overwritten
+            with self._claim_guard():
+                stored_best = study._storage.get_study_system_attrs(study._study_id).get(GLOBAL_BEST_ATTR)
+                if (stored_best is None) or (fitness > stored_best['score']):
+                    study._storage.set_study_system_attr(study._study_id, GLOBAL_BEST_ATTR,
+                                                         {'score': fitness, 'position': position.tolist()})
 
 
 class _HPBound:
@@ -143,15 +418,19 @@ class _HPBound:
             self.categorical_id = categorical_id
             self.low = 0
             self.high = 1
-        elif isinstance(distribution, (IntDistribution, FloatDistribution)):
-            self.low = distribution.low
-            self.high = distribution.high
+        elif isinstance(distribution, IntDistribution):
+            self.scale = INT_LOG_SCALE if distribution.log else INT_SCALE
+            self.step = distribution.step
+            self.low, self.high = encode_bound(distribution.low, distribution.high, self.scale, self.step)
+        elif isinstance(distribution, FloatDistribution):
+            self.scale = LOG_SCALE if distribution.log else None
+            self.step = 1
+            self.low, self.high = encode_bound(distribution.low, distribution.high, self.scale)
         else:
             raise ValueError('Invalid distribution type')
 
-    def round_to_nearest_low_multiple(self, n):
-        if isinstance(self.distribution, IntDistribution):
-            return int((((n - self.low) // self.distribution.step) * self.distribution.step) + self.low)
+    def decode(self, x):
+        return decode_value(x, self.distribution.low, self.distribution.high, self.scale, self.step)
 
 
 class Particle:
@@ -162,6 +441,7 @@ class Particle:
         self.velocity = np.random.uniform(-1, 1, size=bounds.shape[0])
         self.personal_best_position = np.copy(self.position)
         self.personal_best_score = -np.inf
+        self.generation = 0
 
     def update_velocity(self, global_best_position, w, c1, c2):
         r1 = np.random.uniform(0, 1.5, size=self.velocity.shape)
@@ -176,3 +456,24 @@ class Particle:
         self.position += self.velocity
         self.position = np.clip(self.position, bounds[:, 0], bounds[:, 1])
 
+    def to_dict(self):
+        return {
+            'particle_id': self.particle_id,
+            'position': self.position.tolist(),
+            'velocity': self.velocity.tolist(),
+            'personal_best_position': self.personal_best_position.tolist(),
+            'personal_best_score': self.personal_best_score if np.isfinite(self.personal_best_score) else None,
+            'generation': self.generation,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        particle = cls.__new__(cls)
+        particle.particle_id = data['particle_id']
+        particle.position = np.array(data['position'])
+        particle.velocity = np.array(data['velocity'])
+        particle.personal_best_position = np.array(data['personal_best_position'])
+        particle.personal_best_score = data['personal_best_score'] if data['personal_best_score'] is not None else -np.inf
+        particle.generation = data.get('generation', 0)
+        return particle
+
@@ -0,0 +1,52 @@
+import torch
+
+BATCHED_OPTIMIZERS = ('SGD', 'Adam')
+
+
+class BatchedOptimizer:
+    # SGD/Adam over the stacked parameters of a BatchedMLP, with one optimizer type and learning rate per model
+    def __init__(self, params, optimizer_strs, learning_rates, betas=(0.9, 0.999), eps=1e-8):
+        for optimizer_str in optimizer_strs:
+            if optimizer_str not in BATCHED_OPTIMIZERS:
+                raise ValueError(f"Optimizer {optimizer_str} not supported.")
+
+        self.params = list(params)
+        self.betas = betas
+        self.eps = eps
+
+        device = self.params[0].device
+        self.learning_rates = torch.tensor(learning_rates, dtype=torch.float32, device=device)
+        self.is_adam = torch.tensor([optimizer_str == 'Adam' for optimizer_str in optimizer_strs], device=device)
+        self.active = torch.ones(len(optimizer_strs), dtype=torch.bool, device=device)
+
+        self.step_count = 0
+        self.exp_avgs = [torch.zeros_like(param) for param in self.params]
+        self.exp_avg_sqs = [torch.zeros_like(param) for param in self.params]
+
+    def deactivate(self, index):
+        # Early-stopped or pruned models keep their parameters frozen for the rest of the training
+        self.active[index] = False
+
+    @torch.no_grad()
+    def step(self):
+        self.step_count += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2 = 1 - beta2 ** self.step_count
+
+        for param, exp_avg, exp_avg_sq in zip(self.params, self.exp_avgs, self.exp_avg_sqs):
+            if param.grad is None:
+                continue
+            grad = param.grad
+            shape = (-1,) + (1,) * (param.dim() - 1)
+
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            adam_update = (exp_avg / bias_correction1) / ((exp_avg_sq / bias_correction2).sqrt() + self.eps)
+
+            update = torch.where(self.is_adam.view(shape), adam_update, grad)
+            param.sub_(update * (self.learning_rates * self.active).view(shape))
+
+    def zero_grad(self):
+        for param in self.params:
+            param.grad = None
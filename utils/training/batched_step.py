@@ -0,0 +1,60 @@
+import torch
+
+from utils.metrics.metrics_handler import MetricsHandler
+from utils.misc.device import get_device
+
+
+def batched_train_step(dataloader, batched_models, loss_fn, optimizers):
+    # Set the Device
+    device = get_device()
+
+    # Set the Models to Training Mode
+    for batched_model in batched_models:
+        batched_model.train()
+
+    for X, y in dataloader:
+        # Mount data to device (once for every model)
+        X, y = X.to(device), y.to(device)
+
+        for batched_model, optimizer in zip(batched_models, optimizers):
+            # Compute predictions and losses of every model in one forward pass
+            preds = batched_model(X)
+            losses = torch.stack([loss_fn(pred, y) for pred in preds])
+
+            # Backpropagation (parameters are disjoint, so the sum yields each model's own gradients)
+            (losses * optimizer.active).sum().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+
+
+def batched_eval_step(dataloader, batched_model, loss_fn):
+    # Set the Device
+    device = get_device()
+
+    # Initialize values for loss
+    num_batches = len(dataloader)
+    val_losses = torch.zeros(batched_model.num_models)
+
+    # Initialize metrics (one handler per model)
+    metrics_handlers = [MetricsHandler(mode='standard', num_classes=10, device=device) for _ in range(batched_model.num_models)]
+
+    # Set the Model to Evaluation Mode
+    batched_model.eval()
+
+    # Evaluation Step
+    with torch.no_grad():
+        for X, y in dataloader:
+            # Mount data to device
+            X, y = X.to(device), y.to(device)
+
+            # Compute predictions and losses
+            preds = batched_model(X)
+            for index, pred in enumerate(preds):
+                val_losses[index] += loss_fn(pred, y).item()
+
+                # Update metrics
+                metrics_handlers[index].update_metrics(pred, y)
+
+    avg_losses = (val_losses / num_batches).tolist()
+
+    return avg_losses, [metrics_handler.compute_metrics() for metrics_handler in metrics_handlers]